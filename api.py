@@ -4,14 +4,23 @@
 
 import logging
 import endpoints
-from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from protorpc import remote, messages, message_types
+from google.appengine.ext import ndb
 
-from models import User, Game, Score
+import engine
+from models import User, Game
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm, UserForm
 from models import GameForms, ScoreForms, UserForms, HistoryForm
+from models import MakeMovesForm, MoveResultForm, MovesForm, GameStatsForm
+from models import HintForm
 from utils import get_by_urlsafe
+from utils import get_user, get_user_key, cache_user
+from rankings import get_rankings_page
+from lowscores import get_low_scores_page
+from gamestats import get_game_stats
+from scores import get_scores_page
+from hints import get_pattern_index
+from instrumentation import instrumented
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -19,10 +28,101 @@ GET_GAME_REQUEST = endpoints.ResourceContainer(
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
                     MakeMoveForm,
                     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+                     MakeMovesForm,
+                     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 GET_LOW_SCORES_REQUEST = endpoints.ResourceContainer(
-                          number_of_results = messages.IntegerField(1),)
+                          number_of_results = messages.IntegerField(1),
+                          cursor=messages.StringField(2),)
+SCORES_REQUEST = endpoints.ResourceContainer(
+                 page_size=messages.IntegerField(1),
+                 cursor=messages.StringField(2),)
+USER_SCORES_REQUEST = endpoints.ResourceContainer(
+                      user_name=messages.StringField(1),
+                      page_size=messages.IntegerField(2),
+                      cursor=messages.StringField(3),)
+GET_HISTORY_REQUEST = endpoints.ResourceContainer(
+                      urlsafe_game_key=messages.StringField(1),
+                      offset=messages.IntegerField(2),
+                      limit=messages.IntegerField(3),)
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+                   page_size=messages.IntegerField(1),
+                   cursor=messages.StringField(2),)
+
+# How many times a move is retried when it collides with a concurrent write
+MOVE_RETRIES = 3
+MAX_MOVES_PER_REQUEST = 100
+
+
+def _play_guess(game, guess):
+  """Applies a single guess to game in memory. Returns the response message
+  and the other entities (Score, User) that must be written with the game."""
+  entities = []
+
+  #Ensures guess is lowercase since all target_words are lowercase
+  guess = guess.lower()
+
+  word = engine.get_word(game.target_word)
+  guessed_mask, wrong_mask = game.letter_masks()
+  outcome, game.guessed_mask, game.wrong_mask = engine.play(
+    word, guessed_mask, wrong_mask, guess)
+
+  #Illegal moves don't add to attempt count
+  if outcome in engine.ATTEMPTS:
+    game.attempts += 1
+  if outcome in (engine.CORRECT, engine.WIN):
+    game.word_so_far = engine.reveal(word, game.guessed_mask)
+  if outcome in engine.GAME_OVER:
+    entities = game.end_game(engine.GAME_OVER[outcome])
+
+  game.log_move(guess, outcome)
+  return engine.message(outcome, guess, game.target_word, game.wrong_mask), entities
+
+
+@ndb.transactional(xg=True, retries=MOVE_RETRIES)
+def _make_moves(urlsafe_game_key, guesses, version=None):
+  """Reads the game, applies guesses in order until the game is over and
+  writes the game together with any new Score in a single put_multi, all in
+  one transaction. A concurrent move on the same game makes the commit fail
+  and the whole request is retried against the fresh state. If the client
+  sends the version of the game it last saw, moves based on an outdated state
+  are rejected instead.
+  Returns the game and a (guess, message) pair per guess applied."""
+  game = get_by_urlsafe(urlsafe_game_key, Game)
+  if not game:
+    raise endpoints.NotFoundException('Game not found!')
+  if version is not None and version != game.version:
+    raise endpoints.ConflictException(
+            'The game has changed since version {}!'.format(version))
+  if game.game_over:
+    return game, [(guesses[0],
+                   'Game already over! The word was ' + game.target_word)]
+
+  results = []
+  entities = []
+  for guess in guesses:
+    msg, entities = _play_guess(game, guess)
+    results.append((guess, msg))
+    if game.game_over:
+      break
+  ndb.put_multi([game] + entities)
+  return game, results
+
+
+@ndb.transactional(xg=True, retries=MOVE_RETRIES)
+def _cancel_game(urlsafe_game_key):
+  """Ends the game as a loss with a 3 point penalty and deletes it, in one
+  transaction. Returns the game (None if it doesn't exist) and whether it was
+  cancelled."""
+  game = get_by_urlsafe(urlsafe_game_key, Game)
+  if not game or game.game_over:
+    return game, False
+  game.attempts+=3
+  ndb.put_multi(game.end_game(False))
+  game.key.delete()
+  return game, True
 
 @endpoints.api(name='hangman', version='v1')
 class HangmanApi(remote.Service):
@@ -32,13 +132,16 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
       """Create a User. Requires a unique username"""
-      if User.query(User.name == request.user_name).get():
+      user = None
+      if not get_user_key(request.user_name):
+          user = User.create(request.user_name, request.email)
+      if not user:
           raise endpoints.ConflictException(
                   'A User with that name already exists!')
-      user = User(name=request.user_name, email=request.email)
-      user.put()
+      cache_user(user)
       return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -47,22 +150,29 @@ class HangmanApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
       """Creates new game"""
-      user = User.query(User.name == request.user_name).get()
-      if not user:
+      user_key = get_user_key(request.user_name)
+      if not user_key:
           raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
 
-      game = Game.new_game(user.key)
+      difficulty = request.difficulty and request.difficulty.name.lower()
+      try:
+        game = Game.new_game(user_key, difficulty, request.word_length)
+      except ValueError:
+        raise endpoints.BadRequestException(
+                  'No word matches that difficulty and length!')
 
-      return game.to_form('Good luck playing Hangman! Your word has ' + str(len(game.target_word)) + ' letters.')
+      return game.to_form('Good luck playing Hangman! Your word has ' + str(len(game.target_word)) + ' letters.', request.user_name)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
       """Return the current game state"""
       game = get_by_urlsafe(request.urlsafe_game_key, Game)
@@ -76,109 +186,64 @@ class HangmanApi(remote.Service):
                       path='game/{urlsafe_game_key}/move',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
       """Makes a move. Returns a game state with message"""
-      game = get_by_urlsafe(request.urlsafe_game_key, Game)
+      game, results = _make_moves(request.urlsafe_game_key, [request.guess],
+                                  request.version)
+      return game.to_form(results[0][1])
 
-      if game.game_over:
-        return game.to_form('Game already over! The word was ' + game.target_word)
-
-      #Ensures guess is lowercase since all target_words are lowercase
-      request.guess = request.guess.lower()
-
-      #Allows guessing of entire word but only counts as one attempt
-      #Doesn't provide feedback about individual correct letters to dissuade cheating
-      if request.guess == game.target_word:
-        game.attempts += 1
-        game.end_game(True)
-        msg = 'You win!'
-        game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-        game.put()
-        return game.to_form(msg)
-      elif len(request.guess) == len(game.target_word):
-        game.attempts += 1
-        msg = "That's not the correct word!"
-        game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-        game.put()
-        return game.to_form(msg)
-
-      #Handles illegal moves, doesn't add to attempt count
-      if len(request.guess) != 1:
-        msg = 'Please only enter a single letter.'
-        game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-        game.put()
-        return game.to_form(msg)
-      elif request.guess in game.guessed_letters:
-        msg = 'You have already guessed ' + request.guess + '! Please guess a new letter.'
-        game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-        game.put()
-        return game.to_form(msg)
-      elif request.guess not in "abcdefghijklmnopqrstuvwxyz":
-        msg = 'Only letters are allowed as guesses!'
-        game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-        game.put()
-        return game.to_form(msg)
-
-      game.attempts += 1
-      game.guessed_letters += request.guess
-
-      if request.guess in game.target_word:
-        # Replace asterisks in word_so_far with correctly guessed letters
-        for i in range(len(game.target_word)):
-          if game.target_word[i] in game.guessed_letters:
-            game.word_so_far = game.word_so_far[:i] + game.target_word[i] + game.word_so_far[i+1:]
-        if game.word_so_far == game.target_word:
-          msg = 'You win! The word was ' + game.target_word
-          game.end_game(True)
-          game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-          game.put()
-          return game.to_form(msg)
-        else:
-          msg = 'You guessed correctly!'
-          game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-          game.put()
-          return game.to_form(msg)
-      else:
-        #Calculate number of incorrect guesses
-        incorrect_guesses = 0
-        for i in range(len(game.guessed_letters)):
-          if game.guessed_letters[i] not in game.target_word:
-            incorrect_guesses += 1
-        if incorrect_guesses > 5:
-          game.end_game(False)
-          msg = "You lose! The word was " + game.target_word
-          game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-          game.put()
-          return game.to_form(msg)
-        else:
-          msg = ('Incorrect guess! Letter ' + request.guess + ' is not in the word. You are ' + str(6 - incorrect_guesses) + ' incorrect guess(es) from HANGMAN.')
-          game.history.append("(Guess: " + request.guess + ", Message: " + msg + ")")
-          game.put()
-          return game.to_form(msg)
-
-
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MovesForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+      """Makes a sequence of moves, stopping when the game is over. Returns
+      the result of each move applied and the final game state"""
+      if not request.guesses:
+        raise endpoints.BadRequestException('No guesses given!')
+      if len(request.guesses) > MAX_MOVES_PER_REQUEST:
+        raise endpoints.BadRequestException(
+                'At most {} guesses can be made at once!'.format(
+                  MAX_MOVES_PER_REQUEST))
+      game, results = _make_moves(request.urlsafe_game_key, request.guesses,
+                                  request.version)
+      return MovesForm(
+        results=[MoveResultForm(guess=guess, message=msg)
+                 for guess, msg in results],
+        game=game.to_form(results[-1][1]))
+
+
+    @endpoints.method(request_message=SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-      """Return all scores"""
-      return ScoreForms(items=[score.to_form() for score in Score.query()])
+      """Return a page of all scores, newest first. Scores older than the
+      compaction age come last, one per user and month"""
+      return get_scores_page(request.page_size, request.cursor)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-      """Returns all of an individual User's scores"""
-      user = User.query(User.name == request.user_name).get()
-      if not user:
+      """Returns a page of an individual User's scores, newest first. Scores
+      older than the compaction age come last, one per month"""
+      user_key = get_user_key(request.user_name)
+      if not user_key:
         raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-      scores = Score.query(Score.user == user.key).fetch()
-      if len(scores) > 0:
-        return ScoreForms(items=[score.to_form() for score in scores])
+      scores = get_scores_page(request.page_size, request.cursor, user_key,
+                               request.user_name)
+      if scores.items or request.cursor:
+        return scores
       else:
         raise endpoints.NotFoundException(
                     'No scores yet for this player!')
@@ -188,18 +253,19 @@ class HangmanApi(remote.Service):
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
       """Get an individual user's current games"""
-      user = User.query(User.name == request.user_name).get()
+      user = get_user(request.user_name)
       if not user:
         raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-      games = Game.query(Game.user == user.key)
-      games = games.filter(Game.game_over == False)
-      if games.count() > 0:
-        return GameForms(
-          items=[game.to_form(
-            "User {}'s active games.".format(request.user_name)) for game in games])
+      games = [game for game in ndb.get_multi(user.active_games)
+               if game and not game.game_over]
+      if games:
+        return Game.to_forms(
+          games, "User {}'s active games.".format(request.user_name),
+          {user.key: request.user_name})
       else:
         raise endpoints.NotFoundException('This user has no active games!')
 
@@ -208,16 +274,14 @@ class HangmanApi(remote.Service):
                       path='game/{urlsafe_game_key}/cancel_game',
                       name='cancel_game',
                       http_method='POST')
+    @instrumented
     def cancel_game(self, request):
       """Cancel a game in progress and penalize player"""
-      game = get_by_urlsafe(request.urlsafe_game_key, Game)
-      if game and not game.game_over:
-        game.attempts+=3
-        game.end_game(False)
-        game.key.delete()
+      game, cancelled = _cancel_game(request.urlsafe_game_key)
+      if cancelled:
         return StringMessage(
               message='Game with key{} has been cancelled and player penalized 3 points'.format(request.urlsafe_game_key))
-      elif game and game.game_over:
+      elif game:
         return StringMessage(
               message='Game with key{} is already over!'.format(request.urlsafe_game_key))
       else:
@@ -228,60 +292,68 @@ class HangmanApi(remote.Service):
                       path='scores/low_scores',
                       name='get_low_scores',
                       http_method='GET')
+    @instrumented
     def get_low_scores(self, request):
-      """Generate a list of low scores of won games in ascending order"""
-      scores = Score.query(Score.won == True).order(Score.guesses)
-      scores = scores.fetch(limit=request.number_of_results)
-      return ScoreForms(items=[score.to_form() for score in scores])
+      """Generate a page of low scores of won games in ascending order"""
+      return get_low_scores_page(request.number_of_results, request.cursor)
 
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=UserForms,
                       path='users/rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-      """Get the rankings of each player"""
-      items = []
-      users = User.query()
-      for user in users:
-        wins = 0
-        guesses = 0
-        #Use .fetch() to turn query into an iterable list you can take the len() of
-        scores = Score.query(Score.user == user.key).fetch()
-        if scores:
-          for score in scores:
-            guesses += score.guesses
-            if score.won:
-              wins += 1
-          winning_percentage = 100 * wins/float(len(scores))
-          items.append(user.to_form(wins, guesses, winning_percentage))
-        #Lambda defines nameless inline function
-        #items.sort(key=lambda u: u.winning_percentage, reverse = True)
-        #http://stackoverflow.com/questions/12749398/using-a-comparator-function-to-sort\
-      def _compare_user_games(a, b):
-        """Sort user rankings by winning_percentage, then # wins, then # guesses"""
-        if a.winning_percentage != b.winning_percentage:
-          return int(a.winning_percentage - b.winning_percentage)
-        elif a.wins != b.wins:
-          return int(a.wins - b.wins)
-        else:
-          return b.guesses - a.guesses
-      items = sorted(items, cmp = _compare_user_games, reverse = True)
-      return UserForms(items=items)
+      """Get the rankings of each player, a page at a time"""
+      return get_rankings_page(request.page_size, request.cursor)
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=message_types.VoidMessage,
+                      response_message=GameStatsForm,
+                      path='games/stats',
+                      name='get_game_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_stats(self, request):
+      """Get the number of finished games, their average attempts and the
+      win rate, as of the last statistics update"""
+      return get_game_stats()
+
+    @endpoints.method(request_message=GET_HISTORY_REQUEST,
                       response_message=HistoryForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-      """Retrieves an individual game history"""
+      """Retrieves a page of an individual game history, oldest move first"""
       game = get_by_urlsafe(request.urlsafe_game_key, Game)
       if game:
-        return HistoryForm(items=game.history)
+        items, total = game.get_history(max(request.offset or 0, 0),
+                                        request.limit and max(request.limit, 0))
+        return HistoryForm(items=items, total=total)
       else:
         raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented
+    def get_hint(self, request):
+      """Counts the dictionary words that still fit the game's revealed
+      letters and misses, and suggests the letter to guess next"""
+      game = get_by_urlsafe(request.urlsafe_game_key, Game)
+      if not game:
+        raise endpoints.NotFoundException('Game not found!')
+      if game.game_over:
+        raise endpoints.BadRequestException('Game already over!')
+      hint = get_pattern_index().hint(game.word_so_far,
+                                      game.letter_masks()[0])
+      return HintForm(word_so_far=game.word_so_far,
+                      candidates=hint.candidates, letter=hint.letter)
+
 
 
 api = endpoints.api_server([HangmanApi])
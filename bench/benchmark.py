@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Load generation and benchmarks for the Hangman API, run
+locally against the App Engine testbed's datastore and memcache stubs.
+
+Creates a number of users, plays simulated games through create_user,
+new_game, make_move and cancel_game, then calls the read endpoints. For every
+endpoint it records latency percentiles, API calls per request by service
+and method, and entity bytes written. Runs can be repeated at several data
+set sizes to show how each endpoint scales. Startup is measured separately,
+in fresh interpreters: the time to import the API and the latency of the first
+new_game and make_move, with and without the warmup request beforehand.
+Results are saved as JSON so runs from different commits can be compared.
+
+Usage:
+    python bench/benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --users 50 --games 200 --scales 1,4,16
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SDK = os.environ.get('GAE_SDK', '/usr/local/google_appengine')
+READ_ENDPOINTS = ('get_scores', 'get_user_rankings', 'get_low_scores',
+                  'get_user_games')
+STARTUP_RUNS = 5
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and the app on sys.path"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_ROOT)
+
+
+class RpcRecorder(object):
+    """Counts API calls and entity bytes written while it's recording"""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.bytes_written = 0
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.bytes_written = 0
+
+    def __call__(self, service, call, request, response):
+        self.calls['{}.{}'.format(service, call)] += 1
+        if service == 'datastore_v3' and call == 'Put':
+            self.bytes_written += sum(entity.ByteSize()
+                                      for entity in request.entity_list())
+
+
+class EndpointStats(object):
+    """Latencies and API calls of one endpoint"""
+
+    def __init__(self):
+        self.latencies = []
+        self.calls = collections.Counter()
+        self.bytes_written = 0
+
+    def record(self, seconds, recorder):
+        self.latencies.append(seconds * 1000)
+        self.calls.update(recorder.calls)
+        self.bytes_written += recorder.bytes_written
+
+    def summary(self):
+        count = len(self.latencies)
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(int(p * count), count - 1)]
+        return {
+            'calls': count,
+            'p50_ms': round(percentile(0.50), 3),
+            'p95_ms': round(percentile(0.95), 3),
+            'p99_ms': round(percentile(0.99), 3),
+            'rpcs_per_call': dict((name, round(total / float(count), 2))
+                                  for name, total in self.calls.items()),
+            'bytes_written_per_call': round(self.bytes_written /
+                                            float(count), 1),
+        }
+
+
+class Harness(object):
+    """Calls HangmanApi methods the way the endpoints server would, one
+    request at a time, and records their cost"""
+
+    def __init__(self):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='hangman-bench')
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+
+        self.recorder = RpcRecorder()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', self.recorder)
+        self.stats = collections.defaultdict(EndpointStats)
+
+        start = time.time()
+        import api
+        self.import_ms = (time.time() - start) * 1000
+        self.api_module = api
+        self.service = api.HangmanApi()
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def call(self, name, container, **fields):
+        """Calls endpoint name with a request built from fields"""
+        from google.appengine.ext import ndb
+        # Every call is a new request: nothing survives in ndb's context cache
+        ndb.get_context().clear_cache()
+        request = container.combined_message_class(**fields)
+        self.recorder.reset()
+        start = time.time()
+        try:
+            return getattr(self.service, name)(request)
+        finally:
+            self.stats[name].record(time.time() - start, self.recorder)
+
+    def populate(self, users, games, cancel_rate=0.1):
+        """Creates users and plays games with random guesses"""
+        api = self.api_module
+        names = ['user{}'.format(i) for i in range(users)]
+        for name in names:
+            self.call('create_user', api.USER_REQUEST, user_name=name,
+                      email=name + '@example.com')
+        for _ in range(games):
+            game = self.call('new_game', api.NEW_GAME_REQUEST,
+                             user_name=random.choice(names))
+            if random.random() < cancel_rate:
+                self.call('cancel_game', api.GET_GAME_REQUEST,
+                          urlsafe_game_key=game.urlsafe_key)
+                continue
+            letters = list('abcdefghijklmnopqrstuvwxyz')
+            random.shuffle(letters)
+            for letter in letters:
+                self.call('get_hint', api.GET_GAME_REQUEST,
+                          urlsafe_game_key=game.urlsafe_key)
+                game = self.call('make_move', api.MAKE_MOVE_REQUEST,
+                                 urlsafe_game_key=game.urlsafe_key,
+                                 guess=letter)
+                if game.game_over:
+                    break
+        # Leave some games unfinished for get_user_games
+        for name in names:
+            self.call('new_game', api.NEW_GAME_REQUEST, user_name=name)
+        return names
+
+    def read(self, names, reads):
+        """Calls every read endpoint reads times"""
+        api = self.api_module
+        for _ in range(reads):
+            self.call('get_scores', api.SCORES_REQUEST)
+            self.call('get_user_rankings', api.RANKINGS_REQUEST)
+            self.call('get_low_scores', api.GET_LOW_SCORES_REQUEST,
+                      number_of_results=10)
+            self.call('get_user_games', api.USER_REQUEST,
+                      user_name=random.choice(names))
+
+
+def run_scale(users, games, reads):
+    """Benchmarks one data set size. Returns the summary per endpoint."""
+    harness = Harness()
+    try:
+        names = harness.populate(users, games)
+        harness.read(names, reads)
+        return dict((name, stats.summary())
+                    for name, stats in sorted(harness.stats.items()))
+    finally:
+        harness.close()
+
+
+def bench_engine(number=20000):
+    """Times the game engine and the hint index on their own, in microseconds
+    per call"""
+    import engine
+    from dictionary import get_dictionary
+    from hints import get_pattern_index
+    words = [engine.get_word(word) for word in get_dictionary()]
+    letters = list(engine.ALPHABET)
+
+    def play_game():
+        word = random.choice(words)
+        guessed = wrong = 0
+        for letter in letters:
+            outcome, guessed, wrong = engine.play(word, guessed, wrong, letter)
+            if outcome in engine.GAME_OVER:
+                break
+        return engine.reveal(word, guessed)
+
+    word = words[0]
+    index = get_pattern_index()
+    guessed = engine.letters_mask('etas')
+    pattern = engine.reveal(word, guessed)
+    return {
+        'candidates_us': round(timeit.timeit(
+            lambda: index.candidates(pattern, guessed), number=number) /
+            number * 1e6, 3),
+        'hint_cached_us': round(timeit.timeit(
+            lambda: index.hint(pattern, guessed), number=number) /
+            number * 1e6, 3),
+        'play_us': round(timeit.timeit(
+            lambda: engine.play(word, 0, 0, 'e'), number=number) /
+            number * 1e6, 3),
+        'reveal_us': round(timeit.timeit(
+            lambda: engine.reveal(word, engine.letters_mask('aeiou')),
+            number=number) / number * 1e6, 3),
+        'full_game_us': round(timeit.timeit(play_game, number=number // 10) /
+                              (number // 10) * 1e6, 3),
+    }
+
+
+def probe_startup(warm):
+    """Times the start of a cold instance: importing the API, then the first
+    new_game and make_move, optionally after the warmup request. Only
+    meaningful in a fresh interpreter; see bench_startup."""
+    start = time.time()
+    harness = Harness()
+    try:
+        timings = {'import_ms': harness.import_ms,
+                   'start_ms': (time.time() - start) * 1000}
+        if warm:
+            import warmup
+            start = time.time()
+            warmup.warm_up()
+            timings['warmup_ms'] = (time.time() - start) * 1000
+        api = harness.api_module
+        harness.call('create_user', api.USER_REQUEST, user_name='cold',
+                     email='cold@example.com')
+        game = harness.call('new_game', api.NEW_GAME_REQUEST,
+                            user_name='cold')
+        harness.call('make_move', api.MAKE_MOVE_REQUEST,
+                     urlsafe_game_key=game.urlsafe_key, guess='e')
+        harness.call('new_game', api.NEW_GAME_REQUEST, user_name='cold')
+        for name in ('new_game', 'make_move'):
+            timings['first_{}_ms'.format(name)] = (
+                harness.stats[name].latencies[0])
+        timings['second_new_game_ms'] = harness.stats['new_game'].latencies[1]
+        return timings
+    finally:
+        harness.close()
+
+
+def bench_startup(sdk_path, runs=STARTUP_RUNS):
+    """Runs probe_startup in fresh interpreters, runs times without and with
+    warmup. Returns the median of every timing, in milliseconds."""
+    results = {}
+    for mode in ('cold', 'warm'):
+        samples = collections.defaultdict(list)
+        for _ in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--sdk', sdk_path,
+                 '--probe-startup', mode])
+            for name, value in json.loads(output.splitlines()[-1]).items():
+                samples[name].append(value)
+        results[mode] = dict(
+            (name, round(sorted(values)[len(values) // 2], 3))
+            for name, values in samples.items())
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=APP_ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=DEFAULT_SDK,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=20,
+                        help='users at scale 1')
+    parser.add_argument('--games', type=int, default=100,
+                        help='games played at scale 1')
+    parser.add_argument('--reads', type=int, default=50,
+                        help='calls of each read endpoint per scale')
+    parser.add_argument('--scales', default='1',
+                        help='comma separated multipliers of users and games')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--startup-runs', type=int, default=STARTUP_RUNS,
+                        help='fresh interpreters started per startup mode')
+    parser.add_argument('--probe-startup', choices=('cold', 'warm'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--output',
+                        help='JSON file to write, by default '
+                             'bench/results/<commit>.json')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    random.seed(args.seed)
+    if args.probe_startup:
+        print(json.dumps(probe_startup(args.probe_startup == 'warm')))
+        return
+
+    commit = git_commit()
+    results = {'commit': commit, 'timestamp': int(time.time()),
+               'reads': args.reads, 'engine': bench_engine(),
+               'startup': bench_startup(args.sdk, args.startup_runs),
+               'scales': []}
+    for scale in [int(s) for s in args.scales.split(',')]:
+        users, games = args.users * scale, args.games * scale
+        print('Benchmarking {} users, {} games...'.format(users, games))
+        results['scales'].append({'users': users, 'games': games,
+                                  'endpoints': run_scale(users, games,
+                                                         args.reads)})
+
+    output = args.output or os.path.join(APP_ROOT, 'bench', 'results',
+                                         commit + '.json')
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to ' + output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""cache.py - Versioned read-through cache for frequently read entities.
+
+Reads go through a small in-process LRU, then memcache, then the datastore.
+Every cached copy carries the entity's version, and memcache also keeps the
+latest version of each entity on its own. A local copy is only served if it
+matches that version, so a write made on one instance is seen by all of them.
+Writes go through to memcache once they are committed. Cached values only
+ever move to a newer version (compare-and-set), so a slow write can't
+overwrite a newer one."""
+
+import collections
+import sys
+import threading
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+# Version recorded for deleted entities; nothing can replace it
+DELETED = sys.maxint
+CAS_RETRIES = 3
+
+_adapter = ndb.ModelAdapter()
+
+
+class VersionedCache(object):
+    """Caches entities of one model that have an integer version property,
+    bumped on every write"""
+
+    def __init__(self, prefix, capacity=1000, version_attr='version'):
+        self.prefix = prefix
+        self.capacity = capacity
+        self.version_attr = version_attr
+        self.stats = collections.Counter()
+        self._local = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _keys(self, key):
+        urlsafe = key.urlsafe()
+        return ('%s:v:%s' % (self.prefix, urlsafe),
+                '%s:e:%s' % (self.prefix, urlsafe))
+
+    def _get_local(self, key, version):
+        with self._lock:
+            cached = self._local.pop(key, None)
+            if cached is None or cached[0] != version:
+                return None
+            self._local[key] = cached
+            return cached[1]
+
+    def _set_local(self, key, version, data):
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = (version, data)
+            if len(self._local) > self.capacity:
+                self._local.popitem(last=False)
+
+    def get(self, key):
+        """Returns the entity key points to, or None if it doesn't exist"""
+        version_key, entity_key = self._keys(key)
+        version = memcache.get(version_key)
+        if version == DELETED:
+            self.stats['memcache_hit'] += 1
+            return None
+        if version is not None:
+            data = self._get_local(key, version)
+            if data is not None:
+                self.stats['local_hit'] += 1
+                return _decode(data)
+            self.stats['local_miss'] += 1
+            cached = memcache.get(entity_key)
+            if cached is not None and cached[0] == version:
+                self.stats['memcache_hit'] += 1
+                self._set_local(key, version, cached[1])
+                return _decode(cached[1])
+        self.stats['memcache_miss'] += 1
+
+        entity = key.get()
+        self.stats['datastore_hit' if entity else 'datastore_miss'] += 1
+        if entity:
+            self._write(entity.key, getattr(entity, self.version_attr),
+                        _encode(entity))
+        return entity
+
+    def set(self, entity):
+        """Writes a committed entity through to the cache. Inside a
+        transaction this waits until the transaction commits."""
+        version = getattr(entity, self.version_attr)
+        data = _encode(entity)
+        ndb.get_context().call_on_commit(
+            lambda: self._write(entity.key, version, data))
+
+    def delete(self, key):
+        """Records that the entity was deleted, once that's committed"""
+        ndb.get_context().call_on_commit(
+            lambda: self._write(key, DELETED, None))
+
+    def _write(self, key, version, data):
+        version_key, entity_key = self._keys(key)
+        # The entity goes first: a reader that sees the new version but an
+        # older entity falls back to the datastore, never the other way round
+        if not (_raise_to(entity_key, version, (version, data)) and
+                _raise_to(version_key, version, version)):
+            memcache.delete_multi([version_key, entity_key])
+        if data is not None:
+            self._set_local(key, version, data)
+        else:
+            with self._lock:
+                self._local.pop(key, None)
+
+
+def _version_of(value):
+    return value[0] if isinstance(value, tuple) else value
+
+
+def _raise_to(cache_key, version, value):
+    """Sets cache_key to value unless memcache already holds the same or a
+    newer version. Returns False if that couldn't be settled."""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        current = client.gets(cache_key)
+        if current is None:
+            if client.add(cache_key, value):
+                return True
+        elif _version_of(current) >= version:
+            return True
+        elif client.cas(cache_key, value):
+            return True
+    return False
+
+
+def _encode(entity):
+    return _adapter.entity_to_pb(entity).Encode()
+
+
+def _decode(data):
+    return _adapter.pb_to_entity(entity_pb.EntityProto(data))
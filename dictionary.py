@@ -0,0 +1,122 @@
+"""dictionary.py - Word lists that target words are drawn from.
+
+Each locale's word list lives in dictionaries/<locale>.txt, one lowercase word
+per line (lines starting with '#' are comments). A list is loaded at most once
+per instance, the first time it's needed, into a single string plus arrays of
+word offsets, so a dictionary of 100k+ words takes a few MB. Words are
+bucketed by length, number of distinct letters and difficulty, and a random
+word can be drawn from any bucket in constant time."""
+
+import os
+import random
+import re
+import threading
+from array import array
+
+DICTIONARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'dictionaries')
+DEFAULT_LOCALE = 'en'
+
+EASY = 'easy'
+MEDIUM = 'medium'
+HARD = 'hard'
+DIFFICULTIES = (EASY, MEDIUM, HARD)
+# Letters that rarely occur in English words, so are rarely guessed early
+RARE_LETTERS = frozenset('bfgjkqvwxyz')
+
+_WORD = re.compile(r'^[a-z]+$')
+_dictionaries = {}
+_lock = threading.Lock()
+
+
+def word_difficulty(word):
+    """Rates how hard a word is to guess. Words with few distinct letters
+    give few chances of a correct guess, and rare letters are guessed late."""
+    letters = set(word)
+    rare = len(letters & RARE_LETTERS)
+    if len(letters) <= 4 or rare >= 2:
+        return HARD
+    if len(letters) >= 7 and not rare:
+        return EASY
+    return MEDIUM
+
+
+def _bucket(index, key):
+    """Returns the word index array for key, creating it if needed"""
+    bucket = index.get(key)
+    if bucket is None:
+        bucket = index[key] = array('I')
+    return bucket
+
+
+class Dictionary(object):
+    """An immutable, indexed word list"""
+
+    def __init__(self, words):
+        """Builds the dictionary from an iterable of words. Anything that isn't
+        a lowercase ASCII word, and repeated words, are skipped."""
+        chunks = []
+        self._offsets = array('I', [0])
+        self.by_length = {}
+        self.by_distinct_letters = {}
+        self.by_difficulty = {}
+        self._by_length_and_difficulty = {}
+        seen = set()
+        for word in words:
+            if word in seen or not _WORD.match(word):
+                continue
+            seen.add(word)
+            index = len(self._offsets) - 1
+            chunks.append(word)
+            self._offsets.append(self._offsets[-1] + len(word))
+            difficulty = word_difficulty(word)
+            _bucket(self.by_length, len(word)).append(index)
+            _bucket(self.by_distinct_letters, len(set(word))).append(index)
+            _bucket(self.by_difficulty, difficulty).append(index)
+            _bucket(self._by_length_and_difficulty,
+                    (len(word), difficulty)).append(index)
+        self._text = ''.join(chunks)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a word file"""
+        with open(path) as f:
+            return cls(line.strip().lower() for line in f
+                       if not line.startswith('#'))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._text[self._offsets[index]:self._offsets[index + 1]]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def random_word(self, difficulty=None, length=None):
+        """Returns a random word, optionally of the given difficulty and/or
+        length. Raises ValueError if no word matches."""
+        if difficulty and length:
+            bucket = self._by_length_and_difficulty.get((length, difficulty))
+        elif difficulty:
+            bucket = self.by_difficulty.get(difficulty)
+        elif length:
+            bucket = self.by_length.get(length)
+        else:
+            bucket = xrange(len(self))
+        if not bucket:
+            raise ValueError('No word matches those constraints')
+        return self[bucket[random.randrange(len(bucket))]]
+
+
+def get_dictionary(locale=DEFAULT_LOCALE):
+    """Returns the Dictionary of a locale, loading it on first use"""
+    dictionary = _dictionaries.get(locale)
+    if dictionary is None:
+        with _lock:
+            dictionary = _dictionaries.get(locale)
+            if dictionary is None:
+                path = os.path.join(DICTIONARY_DIR, locale + '.txt')
+                dictionary = _dictionaries[locale] = Dictionary.load(path)
+    return dictionary
@@ -0,0 +1,142 @@
+"""engine.py - Hangman game rules, independent of the datastore.
+
+A game's state is two 26-bit letter masks: every letter guessed so far and
+the incorrect ones among them. Each word is indexed once into its own letter
+mask and a letter -> positions map, so scoring a guess, counting misses and
+checking for a win are a few bit operations whatever the word length."""
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+LETTER_BITS = dict((letter, 1 << i) for i, letter in enumerate(ALPHABET))
+MAX_INCORRECT_GUESSES = 6
+# Indexed words are kept for reuse; the memo is simply reset once it holds
+# this many words so a large dictionary can't grow it without bound.
+MAX_INDEXED_WORDS = 20000
+
+# Outcomes of a guess
+WORD_CORRECT = 0
+WORD_INCORRECT = 1
+NOT_SINGLE_LETTER = 2
+ALREADY_GUESSED = 3
+NOT_A_LETTER = 4
+CORRECT = 5
+WIN = 6
+INCORRECT = 7
+LOSE = 8
+
+# Outcomes that count as an attempt; the others are illegal moves
+ATTEMPTS = frozenset([WORD_CORRECT, WORD_INCORRECT, CORRECT, WIN, INCORRECT,
+                      LOSE])
+# Outcomes that end the game, mapped to whether the player won
+GAME_OVER = {WORD_CORRECT: True, WIN: True, LOSE: False}
+
+MESSAGES = {
+    WORD_CORRECT: 'You win!',
+    WORD_INCORRECT: "That's not the correct word!",
+    NOT_SINGLE_LETTER: 'Please only enter a single letter.',
+    ALREADY_GUESSED: ('You have already guessed {guess}! Please guess a new '
+                      'letter.'),
+    NOT_A_LETTER: 'Only letters are allowed as guesses!',
+    CORRECT: 'You guessed correctly!',
+    WIN: 'You win! The word was {word}',
+    INCORRECT: ('Incorrect guess! Letter {guess} is not in the word. You are '
+                '{remaining} incorrect guess(es) from HANGMAN.'),
+    LOSE: 'You lose! The word was {word}',
+}
+
+_indexed_words = {}
+
+
+class Word(object):
+    """A target word with its letter mask and letter -> positions index"""
+    __slots__ = ('word', 'mask', 'positions')
+
+    def __init__(self, word):
+        self.word = word
+        self.mask = 0
+        positions = {}
+        for i, letter in enumerate(word):
+            self.mask |= LETTER_BITS[letter]
+            positions.setdefault(letter, []).append(i)
+        self.positions = dict((LETTER_BITS[letter], tuple(indexes))
+                              for letter, indexes in positions.iteritems())
+
+
+def get_word(word):
+    """Returns the indexed Word for a lowercase word, building it on first
+    use"""
+    indexed = _indexed_words.get(word)
+    if indexed is None:
+        if len(_indexed_words) >= MAX_INDEXED_WORDS:
+            _indexed_words.clear()
+        indexed = _indexed_words[word] = Word(word)
+    return indexed
+
+
+def preload(words):
+    """Indexes every word up front, e.g. a whole dictionary at startup"""
+    for word in words:
+        get_word(word)
+
+
+def letters_mask(letters):
+    """Returns the mask of a string of letters"""
+    mask = 0
+    for letter in letters:
+        mask |= LETTER_BITS.get(letter, 0)
+    return mask
+
+
+def mask_letters(mask):
+    """Returns the letters of a mask in alphabetical order"""
+    return ''.join(letter for letter in ALPHABET if mask & LETTER_BITS[letter])
+
+
+def count_letters(mask):
+    """Returns the number of letters in a mask"""
+    return bin(mask).count('1')
+
+
+def reveal(word, guessed_mask):
+    """Returns word with every letter not guessed yet replaced by '*'"""
+    chars = ['*'] * len(word.word)
+    letters = word.word
+    for bit, indexes in word.positions.iteritems():
+        if guessed_mask & bit:
+            for i in indexes:
+                chars[i] = letters[i]
+    return ''.join(chars)
+
+
+def play(word, guessed_mask, wrong_mask, guess):
+    """Scores a lowercase guess against word. Entire words may be guessed but
+    give no feedback about individual letters.
+    Returns the outcome and the new guessed and wrong masks."""
+    if guess == word.word:
+        return WORD_CORRECT, guessed_mask, wrong_mask
+    if len(guess) == len(word.word):
+        return WORD_INCORRECT, guessed_mask, wrong_mask
+    if len(guess) != 1:
+        return NOT_SINGLE_LETTER, guessed_mask, wrong_mask
+    bit = LETTER_BITS.get(guess)
+    if bit is None:
+        return NOT_A_LETTER, guessed_mask, wrong_mask
+    if guessed_mask & bit:
+        return ALREADY_GUESSED, guessed_mask, wrong_mask
+
+    guessed_mask |= bit
+    if word.mask & bit:
+        if word.mask & ~guessed_mask:
+            return CORRECT, guessed_mask, wrong_mask
+        return WIN, guessed_mask, wrong_mask
+    wrong_mask |= bit
+    if count_letters(wrong_mask) >= MAX_INCORRECT_GUESSES:
+        return LOSE, guessed_mask, wrong_mask
+    return INCORRECT, guessed_mask, wrong_mask
+
+
+def message(outcome, guess, word, wrong_mask):
+    """Returns the message shown to the player for the outcome of a guess.
+    wrong_mask is the mask of incorrect letters after the guess."""
+    return MESSAGES[outcome].format(
+        guess=guess, word=word,
+        remaining=MAX_INCORRECT_GUESSES - count_letters(wrong_mask))
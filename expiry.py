@@ -0,0 +1,152 @@
+"""expiry.py - Deletes abandoned games.
+
+Unfinished games with no move for longer than a TTL are deleted and dropped
+from their users' active_games. A run splits the time range of the stale
+games' last moves into EXPIRY_SHARDS shards and processes each shard as its
+own chain of tasks, one batch per task. A batch reads the keys and users of
+its games with a projection query and deletes them user by user: each user's
+stale games are rechecked and deleted with one delete_multi in the same
+transaction that updates the user, so a move made meanwhile keeps its game.
+Throughput and the backlog are counted in memcache."""
+
+import collections
+import logging
+import time
+from datetime import date, datetime, timedelta
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Game
+from utils import get_cursor, urlsafe_cursor
+
+TASK_URL = '/tasks/expire_games'
+DEFAULT_TTL_DAYS = 30
+EXPIRY_SHARDS = 8
+EXPIRY_BATCH_SIZE = 100
+# Counting the backlog stops here
+BACKLOG_LIMIT = 10000
+# Leaves room for the User in a cross group transaction
+GAMES_PER_TRANSACTION = 24
+COUNTERS = ('batches', 'scanned', 'expired', 'users', 'busy_ms')
+EPOCH = datetime(1970, 1, 1)
+
+
+def _counters_prefix(run):
+    return 'expire_games:{}:'.format(run)
+
+
+def _to_param(moment):
+    delta = moment - EPOCH
+    return str((delta.days * 24 * 60 * 60 + delta.seconds) * 10 ** 6 +
+               delta.microseconds)
+
+
+def parse_moment(value):
+    """Parses a shard boundary passed to a batch task"""
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def stale_query(start, end):
+    """Unfinished games whose last move was in [start, end)"""
+    return Game.query(Game.game_over == False, Game.last_move >= start,
+                      Game.last_move < end)
+
+
+def _enqueue(run, shard, page, start, end, cursor=None):
+    """Adds the task for one batch of a shard, unless it was already added in
+    this run"""
+    from google.appengine.api import taskqueue
+    params = {'run': run, 'shard': shard, 'page': page,
+              'start': _to_param(start), 'end': _to_param(end)}
+    if cursor:
+        params['cursor'] = cursor
+    try:
+        taskqueue.add(url=TASK_URL, params=params,
+                      name='expire-games-{}-{}-{}'.format(run, shard, page))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Expiry batch %d of shard %d of run %s was already '
+                     'enqueued', page, shard, run)
+
+
+def start(ttl_days=DEFAULT_TTL_DAYS, run=None):
+    """Starts an expiry run of the games with no move for ttl_days, one task
+    chain per shard. Returns the run's name."""
+    run = run or date.today().strftime('%Y%m%d')
+    cutoff = datetime.now() - timedelta(days=ttl_days)
+    query = Game.query(Game.game_over == False, Game.last_move < cutoff)
+    oldest = query.order(Game.last_move).get(
+        projection=[Game.last_move, Game.user])
+    backlog = query.count(BACKLOG_LIMIT)
+    memcache.set(_counters_prefix(run) + 'backlog', backlog)
+    logging.info('Game expiry %s: %d stale games (counted up to %d)', run,
+                 backlog, BACKLOG_LIMIT)
+    if not oldest:
+        return run
+    width = (cutoff - oldest.last_move) // EXPIRY_SHARDS
+    for shard in range(EXPIRY_SHARDS):
+        end = (cutoff if shard == EXPIRY_SHARDS - 1 else
+               oldest.last_move + width * (shard + 1))
+        _enqueue(run, shard, 0, oldest.last_move + width * shard, end)
+    return run
+
+
+@ndb.transactional(xg=True)
+def _expire_user_games(user_key, game_keys, end):
+    """Deletes those of game_keys that are still unfinished and had no move
+    since end, and drops them from the user's active_games. Returns how many
+    were deleted."""
+    games = ndb.get_multi(game_keys)
+    stale = [game.key for game in games
+             if game and not game.game_over and game.last_move < end]
+    if not stale:
+        return 0
+    user = user_key.get()
+    if user:
+        user.active_games = [key for key in user.active_games
+                             if key not in stale]
+        user.put()
+    ndb.delete_multi(stale)
+    return len(stale)
+
+
+def expire_batch(run, shard, page, start, end, cursor=None):
+    """Deletes one batch of a shard's stale games and enqueues the next
+    batch"""
+    began = time.time()
+    games, next_cursor, more = stale_query(start, end).fetch_page(
+        EXPIRY_BATCH_SIZE, start_cursor=get_cursor(cursor),
+        projection=[Game.user])
+    if more:
+        _enqueue(run, shard, page + 1, start, end,
+                 urlsafe_cursor(next_cursor, more))
+
+    by_user = collections.defaultdict(list)
+    for game in games:
+        by_user[game.user].append(game.key)
+    expired = 0
+    for user_key, game_keys in by_user.items():
+        for i in range(0, len(game_keys), GAMES_PER_TRANSACTION):
+            expired += _expire_user_games(
+                user_key, game_keys[i:i + GAMES_PER_TRANSACTION], end)
+
+    busy_ms = int((time.time() - began) * 1000)
+    memcache.offset_multi({'batches': 1, 'scanned': len(games),
+                           'expired': expired, 'users': len(by_user),
+                           'busy_ms': busy_ms},
+                          key_prefix=_counters_prefix(run), initial_value=0)
+    logging.info('Game expiry %s shard %d batch %d: %d of %d games deleted '
+                 'for %d users in %d ms', run, shard, page, expired,
+                 len(games), len(by_user), busy_ms)
+
+
+def progress(run):
+    """Returns the counters of an expiry run as a dict, with the backlog
+    counted when it started and the games deleted per second of work"""
+    prefix = _counters_prefix(run)
+    counts = memcache.get_multi(COUNTERS + ('backlog',), key_prefix=prefix)
+    stats = dict((counter, counts.get(counter, 0)) for counter in COUNTERS)
+    stats['backlog'] = counts.get('backlog')
+    if stats['busy_ms']:
+        stats['expired_per_second'] = round(
+            stats['expired'] * 1000.0 / stats['busy_ms'], 1)
+    return stats
@@ -0,0 +1,136 @@
+"""gamestats.py - Statistics of all finished games, folded from the
+GameStatsShard counters that Game.end_game bumps into one cached value.
+
+The shards only count the games that end after they were deployed. The
+backfill counts the existing Scores and ScoreSummaries in chained batches,
+carrying its running totals from task to task, and stores what the shards
+are missing on one more GameStatsShard. Scores of games that ended after
+the backfill started are left to the shards."""
+
+import logging
+from datetime import datetime
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import GameStatsShard, GameStatsForm, Score, ScoreSummary
+from utils import get_cursor, urlsafe_cursor
+
+STATS_KEY = 'game_stats'
+BACKFILL_URL = '/tasks/backfill_game_stats'
+BACKFILL_BATCH_SIZE = 500
+MOMENT_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _add_up(shards):
+    """The games, wins and attempts of shards, as a list"""
+    totals = [0, 0, 0]
+    for shard in shards:
+        if shard:
+            totals[0] += shard.games
+            totals[1] += shard.wins
+            totals[2] += shard.attempts
+    return totals
+
+
+def cache_game_stats():
+    """Adds up every GameStatsShard and caches the totals, the average
+    attempts per game and the win rate. Returns them as a dict."""
+    games, wins, attempts = _add_up(ndb.get_multi(
+        GameStatsShard.shard_keys() + [GameStatsShard.backfill_key()]))
+    stats = {
+        'games_finished': games,
+        'games_won': wins,
+        'average_attempts': float(attempts) / games if games else 0.0,
+        'win_rate': float(wins) / games if games else 0.0,
+    }
+    memcache.set(STATS_KEY, stats)
+    logging.info('Game stats: %s', stats)
+    return stats
+
+
+def get_game_stats():
+    """Returns the cached game statistics as a GameStatsForm. They are as
+    fresh as the last /tasks/cache_average_attempts run."""
+    stats = memcache.get(STATS_KEY)
+    if stats is None:
+        stats = cache_game_stats()
+    return GameStatsForm(**stats)
+
+
+def parse_totals(value):
+    """Parses games, wins and attempts passed to a backfill task"""
+    return [int(total) for total in value.split(',')]
+
+
+def parse_moment(value):
+    """Parses the start of a backfill passed to a batch task"""
+    return datetime.strptime(value, MOMENT_FORMAT)
+
+
+def _enqueue(run, page, started, counted, totals, phase, cursor=None):
+    """Adds the task for one backfill batch, unless it was already added in
+    this run"""
+    from google.appengine.api import taskqueue
+    params = {'run': run, 'page': page, 'phase': phase,
+              'started': started.strftime(MOMENT_FORMAT),
+              'counted': ','.join(map(str, counted)),
+              'totals': ','.join(map(str, totals))}
+    if cursor:
+        params['cursor'] = cursor
+    try:
+        taskqueue.add(url=BACKFILL_URL, params=params,
+                      name='backfill-game-stats-{}-{}'.format(run, page))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Game stats backfill batch %d of run %s was already '
+                     'enqueued', page, run)
+
+
+def start_backfill():
+    """Starts counting the existing Scores and ScoreSummaries into the game
+    statistics. Returns the run's name."""
+    started = datetime.now()
+    run = started.strftime('%Y%m%d%H%M%S')
+    # What the shards have counted so far, all of it also in Score
+    counted = _add_up(ndb.get_multi(GameStatsShard.shard_keys()))
+    _enqueue(run, 0, started, counted, [0, 0, 0], 'scores')
+    return run
+
+
+def backfill_batch(run, page, started, counted, totals, phase, cursor=None):
+    """Adds one batch of Scores, or of ScoreSummaries once the Scores are
+    done, to totals and enqueues the next batch. The last batch stores the
+    difference between totals and the shards counted when the run started,
+    and caches the statistics again."""
+    if phase == 'scores':
+        scores, next_cursor, more = Score.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=get_cursor(cursor))
+        for score in scores:
+            # Games that ended since the run started are only on the shards
+            if score.finished and score.finished >= started:
+                continue
+            totals[0] += 1
+            totals[1] += 1 if score.won else 0
+            totals[2] += score.guesses
+        items = len(scores)
+    else:
+        summaries, next_cursor, more = ScoreSummary.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=get_cursor(cursor))
+        for summary in summaries:
+            totals[0] += summary.games
+            totals[1] += summary.wins
+            totals[2] += summary.guesses
+        items = len(summaries)
+    logging.info('Game stats backfill %s batch %d: %d %s', run, page, items,
+                 phase)
+
+    if more:
+        _enqueue(run, page + 1, started, counted, totals, phase,
+                 urlsafe_cursor(next_cursor, more))
+    elif phase == 'scores':
+        _enqueue(run, page + 1, started, counted, totals, 'summaries')
+    else:
+        games, wins, attempts = [total - shards
+                                 for total, shards in zip(totals, counted)]
+        GameStatsShard(key=GameStatsShard.backfill_key(), games=games,
+                       wins=wins, attempts=attempts).put()
+        cache_game_stats()
@@ -0,0 +1,164 @@
+"""hints.py - Candidate words and suggested letters for a game in progress.
+
+A PatternIndex is built once per instance over a Dictionary. The words of
+each length are numbered, and every (position, letter) pair and every letter
+gets the set of word numbers it matches, stored as a Python integer bitset.
+Filtering the words that fit a revealed pattern and the letters guessed is
+then one AND per revealed or excluded letter, whatever the size of the
+dictionary. Hints are also kept in a small LRU, keyed by pattern and guessed
+letters, since many games share the same early states."""
+
+import binascii
+import collections
+import threading
+
+import engine
+from dictionary import get_dictionary, DEFAULT_LOCALE
+
+HIDDEN = '*'
+HINT_CACHE_SIZE = 10000
+# Below this many candidates, letters are counted word by word rather than
+# by popcount over whole bitsets
+SMALL_CANDIDATE_COUNT = 64
+
+Hint = collections.namedtuple('Hint', ['candidates', 'letter'])
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _bitset(numbers, size):
+    """Returns an integer with the bits of numbers set, numbers < size"""
+    bits = bytearray((size + 7) // 8)
+    for number in numbers:
+        bits[number >> 3] |= 1 << (number & 7)
+    bits.reverse()
+    return int(binascii.hexlify(bytes(bits)) or '0', 16)
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+class _LengthIndex(object):
+    """The bitsets of the words of one length"""
+    __slots__ = ('all', 'at', 'contains', 'masks')
+
+    def __init__(self, words):
+        size = len(words)
+        length = len(words[0])
+        at = [collections.defaultdict(list) for _ in range(length)]
+        contains = collections.defaultdict(list)
+        self.masks = []
+        for number, word in enumerate(words):
+            for position, letter in enumerate(word):
+                at[position][letter].append(number)
+            for letter in set(word):
+                contains[letter].append(number)
+            self.masks.append(engine.letters_mask(word))
+        self.all = (1 << size) - 1
+        # at[position][letter]: the words with letter at position
+        self.at = [dict((letter, _bitset(numbers, size))
+                        for letter, numbers in letters.iteritems())
+                   for letters in at]
+        # contains[letter]: the words with letter anywhere
+        self.contains = dict((letter, _bitset(numbers, size))
+                             for letter, numbers in contains.iteritems())
+
+
+class PatternIndex(object):
+    """Bitset index of a Dictionary's words by length, position and letter"""
+
+    def __init__(self, dictionary, cache_size=HINT_CACHE_SIZE):
+        self._lengths = dict(
+            (length, _LengthIndex([dictionary[index] for index in bucket]))
+            for length, bucket in dictionary.by_length.iteritems())
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def candidates(self, pattern, guessed_mask):
+        """Returns the bitset of the words that pattern could still be, e.g.
+        '*a**e', given the mask of every letter guessed, and the index of
+        their length (None if there are no words of that length)"""
+        index = self._lengths.get(len(pattern))
+        if index is None:
+            return 0, None
+        words = index.all
+        revealed = 0
+        for position, letter in enumerate(pattern):
+            if letter != HIDDEN:
+                words &= index.at[position].get(letter, 0)
+                revealed |= engine.LETTER_BITS.get(letter, 0)
+        hidden = [position for position, letter in enumerate(pattern)
+                  if letter == HIDDEN]
+        for letter in engine.mask_letters(guessed_mask):
+            if not words:
+                break
+            if not engine.LETTER_BITS[letter] & revealed:
+                # A wrong guess: the word doesn't contain it at all
+                words &= ~index.contains.get(letter, 0)
+            else:
+                # A right guess is revealed everywhere it occurs
+                for position in hidden:
+                    words &= ~index.at[position].get(letter, 0)
+        return words, index
+
+    def _suggest(self, words, index, guessed_mask):
+        """The unguessed letter whose guess splits words most evenly, or
+        None if every letter of them has been guessed"""
+        total = _popcount(words)
+        counts = collections.Counter()
+        if total <= SMALL_CANDIDATE_COUNT:
+            remaining = words
+            while remaining:
+                low = remaining & -remaining
+                remaining ^= low
+                counts.update(engine.mask_letters(
+                    index.masks[low.bit_length() - 1] & ~guessed_mask))
+        else:
+            for letter, bits in index.contains.iteritems():
+                if not engine.LETTER_BITS[letter] & guessed_mask:
+                    counts[letter] = _popcount(words & bits)
+        best = None
+        for letter in engine.ALPHABET:
+            count = counts.get(letter, 0)
+            if not count:
+                continue
+            # Prefer the most even split, then the likelier hit
+            rank = (min(count, total - count), count)
+            if best is None or rank > best[0]:
+                best = rank, letter
+        return best[1] if best else None
+
+    def hint(self, pattern, guessed_mask):
+        """Returns a Hint: how many words pattern could still be, and the
+        letter to guess next (None if there's nothing left to learn)"""
+        key = (pattern, guessed_mask)
+        with self._cache_lock:
+            hint = self._cache.pop(key, None)
+            if hint is not None:
+                self._cache[key] = hint
+                return hint
+        words, index = self.candidates(pattern, guessed_mask)
+        hint = Hint(_popcount(words),
+                    self._suggest(words, index, guessed_mask) if words
+                    else None)
+        with self._cache_lock:
+            self._cache[key] = hint
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return hint
+
+
+def get_pattern_index(locale=DEFAULT_LOCALE):
+    """Returns the PatternIndex of a locale's Dictionary, building it on
+    first use"""
+    index = _indexes.get(locale)
+    if index is None:
+        with _lock:
+            index = _indexes.get(locale)
+            if index is None:
+                index = _indexes[locale] = PatternIndex(
+                    get_dictionary(locale))
+    return index
@@ -0,0 +1,114 @@
+"""instrumentation.py - Per-endpoint datastore, memcache and latency stats.
+
+Wrap a request handling method with @instrumented to count, per call, the
+datastore gets, puts, deletes and queries it makes, its memcache hits and
+misses, and its wall time. Only a sample of calls is measured (see
+SAMPLE_RATES), so hot endpoints pay almost nothing. Measured calls are
+folded into an in-process registry, served by the admin stats handler in
+main.py, and written to the log as one JSON line each."""
+
+import collections
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+DEFAULT_SAMPLE_RATE = 1.0
+# Fraction of calls measured, by method name, for the hottest endpoints
+SAMPLE_RATES = {
+    'make_move': 0.01,
+    'make_moves': 0.01,
+    'get_game': 0.01,
+    'get_hint': 0.01,
+    'new_game': 0.1,
+}
+# What each datastore call is counted as
+DATASTORE_CALLS = {
+    'Get': 'datastore_gets',
+    'Put': 'datastore_puts',
+    'Delete': 'datastore_deletes',
+    'RunQuery': 'datastore_queries',
+    'Next': 'datastore_queries',
+    'Commit': 'datastore_commits',
+}
+COUNTERS = ('datastore_gets', 'datastore_puts', 'datastore_deletes',
+            'datastore_queries', 'datastore_commits', 'memcache_hits',
+            'memcache_misses')
+
+_current = threading.local()
+_lock = threading.Lock()
+_registry = collections.defaultdict(collections.Counter)
+
+
+def _post_call_hook(service, call, request, response):
+    """Counts an API call against the measured call running on this thread"""
+    counts = getattr(_current, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3':
+        counter = DATASTORE_CALLS.get(call)
+        if counter:
+            counts[counter] += 1
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counts['memcache_hits'] += hits
+        counts['memcache_misses'] += request.key_size() - hits
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _post_call_hook)
+
+
+def _record(name, counts, elapsed_ms):
+    with _lock:
+        stats = _registry[name]
+        stats['calls'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        stats.update(counts)
+    entry = dict(counts, method=name, elapsed_ms=round(elapsed_ms, 2))
+    logging.info('rpc_stats %s', json.dumps(entry, sort_keys=True))
+
+
+def instrumented(method):
+    """Decorates a handler or endpoint method so a sample of its calls is
+    measured"""
+    rate = SAMPLE_RATES.get(method.__name__, DEFAULT_SAMPLE_RATE)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Calls nested in a measured call are counted as part of it
+        if (random.random() >= rate or
+                getattr(_current, 'counts', None) is not None):
+            return method(self, *args, **kwargs)
+        _current.counts = collections.Counter()
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            counts, _current.counts = _current.counts, None
+            _record('{}.{}'.format(type(self).__name__, method.__name__),
+                    counts, (time.time() - start) * 1000)
+    return wrapper
+
+
+def get_stats():
+    """Returns the stats of every measured method, with averages per call"""
+    with _lock:
+        registry = dict((name, dict(stats))
+                        for name, stats in _registry.items())
+    for stats in registry.values():
+        calls = float(stats['calls'])
+        stats['avg_ms'] = round(stats['total_ms'] / calls, 2)
+        for counter in COUNTERS:
+            stats['avg_' + counter] = round(stats.get(counter, 0) / calls, 2)
+    return registry
+
+
+def reset_stats():
+    with _lock:
+        _registry.clear()
@@ -0,0 +1,80 @@
+"""lowscores.py - Serves get_low_scores from the LowScoreBoard, falling back
+to a Score query only for pages beyond the board."""
+
+import logging
+
+from models import Score, ScoreForm, ScoreForms, ScoreSummary
+from models import LowScoreBoard, LowScoreEntry
+from models import get_user_names, LOW_SCORE_BOARD_SIZE
+from utils import get_cursor, get_page_size, urlsafe_cursor, bad_request
+
+# Page tokens for pages served from the board are offsets into it
+BOARD_CURSOR_PREFIX = 'board:'
+
+
+def _board_offset(cursor):
+    try:
+        return max(int(cursor[len(BOARD_CURSOR_PREFIX):]), 0)
+    except ValueError:
+        raise bad_request('Invalid cursor')
+
+
+def get_low_scores_page(number_of_results=None, cursor=None):
+    """Returns a page of the lowest won scores as a ScoreForms. Pages that lie
+    within the board cost one memcache read; only pages past its
+    LOW_SCORE_BOARD_SIZE entries, or any page before the board is built,
+    query Score."""
+    page_size = get_page_size(number_of_results)
+    offset = 0
+    if cursor and cursor.startswith(BOARD_CURSOR_PREFIX):
+        offset = _board_offset(cursor)
+        cursor = None
+
+    entries = None if cursor else LowScoreBoard.get_entries()
+    if entries is not None:
+        full = len(entries) >= LOW_SCORE_BOARD_SIZE
+        end = offset + page_size
+        # A board that isn't full holds every win there is
+        if end <= len(entries) or not full:
+            page = entries[offset:end]
+            more = end < len(entries) or (full and end == len(entries))
+            user_names = get_user_names([user for _, _, user in page])
+            return ScoreForms(
+                items=[ScoreForm(user_name=user_names[user], date=str(date),
+                                 won=True, guesses=guesses)
+                       for guesses, date, user in page],
+                next_cursor=BOARD_CURSOR_PREFIX + str(end) if more else None)
+
+    scores = Score.query(Score.won == True).order(Score.guesses)
+    scores, next_cursor, more = scores.fetch_page(
+        page_size, start_cursor=get_cursor(cursor), offset=offset,
+        projection=[Score.user, Score.date, Score.guesses])
+    return Score.to_forms(scores, won=True,
+                          next_cursor=urlsafe_cursor(next_cursor, more))
+
+
+def rebuild_board():
+    """Rebuilds the LowScoreBoard from Score, e.g. after it was lost or
+    before it's first used. Compacted months take part with the best wins
+    their summaries kept, dated the first of the month."""
+    scores = Score.query(Score.won == True).order(Score.guesses).fetch_async(
+        LOW_SCORE_BOARD_SIZE, projection=[Score.user, Score.date,
+                                          Score.guesses])
+    summaries = ScoreSummary.query(ScoreSummary.best >= 0).order(
+        ScoreSummary.best).fetch_async(LOW_SCORE_BOARD_SIZE)
+    entries = [LowScoreEntry(user=score.user, date=score.date,
+                             guesses=score.guesses)
+               for score in scores.get_result()]
+    # A summary's wins are never worse than its best, so the summaries with
+    # the LOW_SCORE_BOARD_SIZE lowest bests hold every compacted win that
+    # can make the board
+    entries.extend(LowScoreEntry(user=summary.user, date=summary.month,
+                                 guesses=guesses)
+                   for summary in summaries.get_result()
+                   for guesses in summary.get_best_wins())
+    entries.sort(key=lambda entry: entry.guesses)
+    board = LowScoreBoard(key=LowScoreBoard.board_key(),
+                          entries=entries[:LOW_SCORE_BOARD_SIZE])
+    board.put()
+    logging.info('Rebuilt the low score board with %d entries',
+                 len(board.entries))
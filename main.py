@@ -2,32 +2,192 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
+from datetime import date
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import HangmanApi
 
-from models import User, Game
+import reminders
+import scores
+import expiry
+import gamestats
+from rankings import backfill_user_totals
+from lowscores import rebuild_board
+from migrations import migrate_user_keys, stamp_last_move
+from instrumentation import instrumented, get_stats
+from models import Game
+from warmup import warm_up
+
+
+def _enqueue_next(url, cursor):
+    """Chains the task for the next batch of a backfill or migration"""
+    from google.appengine.api import taskqueue
+    taskqueue.add(url=url, params={'cursor': cursor})
+
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start sending a reminder email to each User with at least 1
+        incomplete game. Called every 24 hours using a cron job"""
+        day = date.today().strftime('%Y%m%d')
+        reminders.start(day)
+        self.response.write('Reminders {}: {}'.format(
+            day, reminders.progress(day)))
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Send the reminder emails of one batch of users"""
+        reminders.send_batch(self.request.get('day'),
+                             int(self.request.get('page')),
+                             self.request.get('cursor') or None)
+
+
+class BackfillUserTotals(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Recompute the ranking totals of every User from their Scores, one
+        batch per task. Start it once by posting to the url with no cursor"""
+        cursor = backfill_user_totals(self.request.get('cursor') or None,
+                                      self.request.get_all('user'))
+        if cursor:
+            _enqueue_next('/tasks/backfill_user_totals', cursor)
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Re-key Users created before names became keys, one batch per task.
+        Start it once by posting to the url with no cursor"""
+        cursor = migrate_user_keys(self.request.get('cursor') or None)
+        if cursor:
+            _enqueue_next('/tasks/migrate_user_keys', cursor)
+
+
+class CompactScores(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start rolling Scores older than max_age_days (90 by default) into
+        monthly ScoreSummaries. Called every 24 hours using a cron job"""
+        max_age_days = int(self.request.get('max_age_days') or
+                           scores.DEFAULT_MAX_AGE_DAYS)
+        run = scores.start(max_age_days)
+        self.response.write('Score compaction {}: {}'.format(
+            run, scores.progress(run)))
+
+    @instrumented
+    def post(self):
+        """Compact one batch of Scores"""
+        scores.compact_batch(self.request.get('run'),
+                             int(self.request.get('page')),
+                             scores.parse_cutoff(self.request.get('cutoff')),
+                             self.request.get('cursor') or None)
+
+
+class ExpireGames(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start deleting unfinished games with no move for ttl_days (30 by
+        default). Called every 24 hours using a cron job"""
+        ttl_days = int(self.request.get('ttl_days') or
+                       expiry.DEFAULT_TTL_DAYS)
+        run = expiry.start(ttl_days)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'run': run,
+                                        'progress': expiry.progress(run)},
+                                       sort_keys=True))
+
+    @instrumented
+    def post(self):
+        """Delete one batch of a shard's stale games"""
+        expiry.expire_batch(self.request.get('run'),
+                            int(self.request.get('shard')),
+                            int(self.request.get('page')),
+                            expiry.parse_moment(self.request.get('start')),
+                            expiry.parse_moment(self.request.get('end')),
+                            self.request.get('cursor') or None)
+
+
+class StampLastMove(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Give unfinished Games from before last_move existed a last move,
+        one batch per task. Start it once by posting to the url with no
+        cursor"""
+        cursor = stamp_last_move(self.request.get('cursor') or None)
+        if cursor:
+            _enqueue_next('/tasks/stamp_last_move', cursor)
+
+
+class RebuildLowScores(webapp2.RequestHandler):
+    @instrumented
     def get(self):
-        """Send a reminder email to each User with at least 1 incomplete game.
-        Called every 24 hours using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            games = Game.query(Game.user == user.key)
-            games = games.filter(Game.game_over == False)
-            if games.count() > 0:
-                subject = 'This is a reminder to prevent an execution!'
-                body = 'Hello {}, please complete your Hangman game!'.format(user.name)
-
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+        """Rebuild the low score board from Score. Called every 24 hours
+        using a cron job, and safe to run by hand at any time"""
+        rebuild_board()
+
+
+class CacheAverageAttempts(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Fold the sharded game counters into the cached game statistics.
+        Called every 5 minutes using a cron job"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(gamestats.cache_game_stats(),
+                                       sort_keys=True))
+
+
+class BackfillGameStats(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Count the games that ended before the GameStatsShards existed into
+        the game statistics, one batch per task. Start it once by posting to
+        the url with no run"""
+        run = self.request.get('run')
+        if not run:
+            self.response.write('Game stats backfill {} started'.format(
+                gamestats.start_backfill()))
+            return
+        gamestats.backfill_batch(
+            run, int(self.request.get('page')),
+            gamestats.parse_moment(self.request.get('started')),
+            gamestats.parse_totals(self.request.get('counted')),
+            gamestats.parse_totals(self.request.get('totals')),
+            self.request.get('phase'), self.request.get('cursor') or None)
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Load the dictionary, the API and the hot caches before the
+        instance serves traffic. Called by App Engine on new instances"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(warm_up()))
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the measured cost of every endpoint and handler on this
+        instance, and the game cache's hit rates, as JSON. Admin only"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'methods': get_stats(),
+                                        'game_cache': dict(Game.cache.stats)},
+                                       indent=2, sort_keys=True))
+
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/backfill_user_totals', BackfillUserTotals),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/cache_average_attempts', CacheAverageAttempts),
+    ('/tasks/backfill_game_stats', BackfillGameStats),
+    ('/tasks/compact_scores', CompactScores),
+    ('/tasks/expire_games', ExpireGames),
+    ('/tasks/stamp_last_move', StampLastMove),
+    ('/tasks/rebuild_low_scores', RebuildLowScores),
+    ('/admin/stats', StatsHandler),
+    ('/_ah/warmup', WarmupHandler),
 ], debug=True)
\ No newline at end of file
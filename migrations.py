@@ -0,0 +1,143 @@
+"""migrations.py - One-off data migrations, run a batch at a time from task
+queue handlers in main.py."""
+
+import logging
+from google.appengine.ext import ndb
+
+from models import User, Game, Score, ScoreSummary, LowScoreBoard
+from utils import get_cursor, urlsafe_cursor, uncache_user
+
+MIGRATION_BATCH_SIZE = 20
+
+
+@ndb.transactional(xg=True)
+def _forward_user(legacy_key):
+    """Copies a legacy User to its name key, unless that exists already, and
+    makes the legacy User forward to it. Returns the name key."""
+    legacy = legacy_key.get()
+    if not legacy:
+        return None
+    if legacy.moved_to:
+        return legacy.moved_to
+    keyed = User.get_by_id(legacy.name)
+    if not keyed:
+        keyed = User(id=legacy.name, **legacy.to_dict(
+            exclude=['ranked', 'has_active_games', 'moved_to']))
+    legacy.moved_to = keyed.key
+    ndb.put_multi([keyed, legacy])
+    return keyed.key
+
+
+@ndb.transactional
+def _repoint(key, old_user, new_user):
+    """Points the Game or Score key at new_user, if it still exists and
+    points at old_user. Returns whether it was changed."""
+    entity = key.get()
+    if not entity or entity.user != old_user:
+        return False
+    entity.user = new_user
+    entity.put()
+    return True
+
+
+@ndb.transactional(xg=True)
+def _move_summary(key, new_user):
+    """Merges a ScoreSummary into new_user's summary of the same month"""
+    summary = key.get()
+    if not summary:
+        return
+    moved_key = ScoreSummary.summary_key(new_user, summary.month)
+    moved = moved_key.get() or ScoreSummary(key=moved_key, user=new_user,
+                                            month=summary.month)
+    moved.merge(summary)
+    moved.put()
+    key.delete()
+
+
+@ndb.transactional
+def _repoint_board(old_user, new_user):
+    """Points the low score board's entries of old_user at new_user"""
+    board = LowScoreBoard.board_key().get()
+    entries = [entry for entry in (board.entries if board else [])
+               if entry.user == old_user]
+    for entry in entries:
+        entry.user = new_user
+    if entries:
+        board.put()
+
+
+@ndb.transactional
+def _delete_legacy_user(legacy_key):
+    legacy = legacy_key.get()
+    if legacy and legacy.moved_to:
+        legacy_key.delete()
+
+
+def _migrate_user_key(user):
+    """Re-keys a User with a numeric id by its name. The first pass copies it
+    and leaves it forwarding to the copy, so anything still pointing at it
+    reaches the copy; it then repoints its Games, Scores, ScoreSummaries and
+    low score board entries, each in its own transaction. A later pass
+    repoints whatever the first one missed, and only deletes the legacy User
+    once it finds nothing left to repoint. Safe to re-run if it's
+    interrupted part way."""
+    forwarded = bool(user.moved_to)
+    keyed_key = _forward_user(user.key)
+    if not keyed_key:
+        return
+    uncache_user(user.name)
+    games = Game.query(Game.user == user.key).fetch_async(keys_only=True)
+    scores = Score.query(Score.user == user.key).fetch_async(keys_only=True)
+    summaries = ScoreSummary.query(ScoreSummary.user == user.key).fetch_async(
+        keys_only=True)
+    # Queries lag recent writes; the user's active games are read by key
+    keyed = keyed_key.get()
+    keys = set(games.get_result() + scores.get_result())
+    keys.update(game.key for game in ndb.get_multi(keyed.active_games)
+                if game and game.user == user.key)
+    repointed = sum(_repoint(key, user.key, keyed_key) for key in keys)
+    for key in summaries.get_result():
+        _move_summary(key, keyed_key)
+    _repoint_board(user.key, keyed_key)
+    if forwarded and not repointed and not summaries.get_result():
+        _delete_legacy_user(user.key)
+        uncache_user(user.name)
+
+
+@ndb.transactional
+def _stamp_last_move(game_key):
+    """Writes a Game that still has no last move, which sets it. Re-read in
+    the transaction so a move made since the query isn't reverted. Returns
+    whether it was written."""
+    game = game_key.get()
+    if not game or game.last_move:
+        return False
+    game.put()
+    return True
+
+
+def stamp_last_move(cursor=None):
+    """Gives one batch of unfinished Games written before Game.last_move
+    existed a last move of now, so they expire a TTL from now. Returns the
+    urlsafe cursor of the next batch, or None when done."""
+    games, next_cursor, more = Game.query(Game.game_over == False).fetch_page(
+        MIGRATION_BATCH_SIZE, start_cursor=get_cursor(cursor))
+    stamped = sum(_stamp_last_move(game.key) for game in games
+                  if not game.last_move)
+    logging.info('Stamped the last move of %d of %d games', stamped,
+                 len(games))
+    return urlsafe_cursor(next_cursor, more)
+
+
+def migrate_user_keys(cursor=None):
+    """Migrates one batch of Users to name keys. Returns the urlsafe cursor of
+    the next batch, or None when done. Run it at least twice: legacy Users
+    are only deleted by a pass after the one that forwarded them."""
+    users, next_cursor, more = User.query().fetch_page(
+        MIGRATION_BATCH_SIZE, start_cursor=get_cursor(cursor))
+    legacy = [user for user in users if not user.key.string_id()]
+    for user in legacy:
+        _migrate_user_key(user)
+    logging.info('Migrated %d of %d users to name keys', len(legacy),
+                 len(users))
+    return urlsafe_cursor(next_cursor, more)
@@ -2,93 +2,261 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
+import bisect
 import random
-from datetime import date
+from datetime import date, datetime
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
-#word list of common English words from http://www.manythings.org/vocabulary/lists/l/words.php?f=noll15
-words = ['acres','adult','advice','arrangement','attempt',
-'autumn','border','breeze','brick','calm','canal','cast','chose',
-'claws','coach','constantly','contrast','cookies','customs','damage',
-'deeply','depth','discussion','doll','donkey',
-'essential','exchange','exist','explanation','facing','film','finest',
-'fireplace','floating','folks','fort','garage','grabbed','grandmother','habit',
-'happily', 'heading','hunter','image','independent',
-'instant','kids','label','lungs','manufacturing',
-'mathematics','melted','memory','mill','mission','monkey','mysterious',
-'neighborhood','nuts','occasionally','official','ourselves','palace',
-'plates','poetry','policeman','positive',
-'possibly','practical','pride','promised','recall','relationship','remarkable',
-'require','rhyme','rocky','rubbed','rush','sale','satellites','satisfied',
-'scared','selection','shake','shaking','shallow','shout','silly','simplest',
-'slight','slip','slope','soap','solar','species','spin','stiff','swung','tales',
-'thumb','tobacco','toy','trap','treated','tune','university','vapor','vessels',
-'wealth','wolf','zoo']
+import engine
+from cache import VersionedCache
+import movelog
+from dictionary import get_dictionary
+
+
+LOW_SCORE_BOARD_SIZE = 100
+LOW_SCORE_BOARD_MEMCACHE_KEY = 'low_scores:board'
+# The cached board is rewritten on every change; the expiry only bounds how
+# long a copy read during a concurrent change can stay out of date
+LOW_SCORE_BOARD_TTL = 60
+# Finished games are counted on this many GameStatsShards, so up to about
+# this many games can end every second without contending on one entity
+GAME_STATS_SHARDS = 20
+
+
+def get_user_names(user_keys, cache=None):
+    """Resolves User keys to user names with at most one get_multi, however
+    many times each key repeats. cache is a key -> name dict that can be shared
+    for the rest of a request; keys already in it cost no datastore RPC."""
+    if cache is None:
+        cache = {}
+    for key in user_keys:
+        # Users are keyed by their name, so most names need no lookup at all
+        if key not in cache and key.string_id():
+            cache[key] = key.string_id()
+    missing = list(set(key for key in user_keys if key not in cache))
+    if missing:
+        for key, user in zip(missing, ndb.get_multi(missing)):
+            cache[key] = user.name if user else None
+    return cache
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by the user's name. wins, guesses, games_played and
+    winning_percentage are running totals over the user's Scores, kept up to
+    date by Game.end_game so the rankings never need to scan Score. Users
+    created before names became keys have numeric ids until they're
+    migrated; once copied to their name key they forward to it (moved_to)
+    until nothing points at them any more."""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     wins = ndb.IntegerProperty(default = 0)
     guesses = ndb.IntegerProperty(default = 0)
+    games_played = ndb.IntegerProperty(default = 0)
     winning_percentage = ndb.FloatProperty(default = 0.0)
+    # The key a migrated legacy User was copied to
+    moved_to = ndb.KeyProperty(kind='User', indexed=False)
+    # Only users with at least one Score appear in the rankings
+    ranked = ndb.ComputedProperty(
+        lambda self: self.games_played > 0 and not self.moved_to)
+    # Keys of the user's unfinished games, kept up to date by Game.new_game
+    # and Game.end_game
+    active_games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    has_active_games = ndb.ComputedProperty(
+        lambda self: bool(self.active_games) and not self.moved_to)
+    # The day of the last reminder mailed to the user, see reminders.py
+    last_reminded = ndb.DateProperty(indexed=False)
 
-    def to_form(self, wins, guesses, winning_percentage):
+    @classmethod
+    def get_current(cls, key):
+        """Gets the User key points to, following moved_to if it was
+        migrated. Returns None if there's no such user."""
+        user = key.get()
+        if user and user.moved_to:
+            user = user.moved_to.get()
+        return user
+
+    def record_score(self, won, guesses):
+        """Folds a single finished game into the running totals"""
+        self.games_played += 1
+        self.guesses += guesses
+        if won:
+            self.wins += 1
+        self.winning_percentage = 100 * self.wins/float(self.games_played)
+
+    def record_summary(self, summary):
+        """Folds a ScoreSummary of one month's finished games into the
+        running totals"""
+        self.games_played += summary.games
+        self.guesses += summary.guesses
+        self.wins += summary.wins
+        if self.games_played:
+            self.winning_percentage = (100 * self.wins /
+                                       float(self.games_played))
+
+    @classmethod
+    @ndb.transactional
+    def create(cls, name, email=None):
+        """Creates a User keyed by name. Returns None if that name is taken;
+        the check and the write happen in one transaction, so two concurrent
+        requests can't both create the same name."""
+        if cls.get_by_id(name):
+            return None
+        user = cls(id=name, name=name, email=email)
+        user.put()
+        return user
+
+    def to_form(self):
         form = UserForm()
         form.user_name = self.name
         form.email = self.email
-        form.wins = wins
-        form.guesses = guesses
-        form.winning_percentage = winning_percentage
+        form.wins = self.wins
+        form.guesses = self.guesses
+        form.winning_percentage = self.winning_percentage
         return form
 
 
 class Game(ndb.Model):
-    """Game object"""
+    """Game object. Games are cached by Game.cache rather than by ndb's own
+    memcache integration; every write bumps version and goes through to it."""
+    _use_memcache = False
+    cache = VersionedCache('game')
+
     user = ndb.KeyProperty(required=True, kind='User')
     target_word = ndb.StringProperty(required=True)
     attempts = ndb.IntegerProperty(required=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
+    # Bumped on every write, so caches and clients can tell when they're out
+    # of date
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # Letters guessed so far and the incorrect ones among them, as engine
+    # letter masks
+    guessed_mask = ndb.IntegerProperty(default=0, indexed=False)
+    wrong_mask = ndb.IntegerProperty(default=0, indexed=False)
+    # Superseded by guessed_mask; only read to carry over games started
+    # before the masks existed
     guessed_letters = ndb.StringProperty()
-    history = ndb.StringProperty(repeated = True)
+    # Every move made, encoded by movelog
+    moves = ndb.BlobProperty()
+    # Readable history of games started before the move log existed
+    history = ndb.StringProperty(repeated = True, indexed = False)
     word_so_far = ndb.StringProperty()
+    # Time of the last write, so abandoned games can be found and expired
+    last_move = ndb.DateTimeProperty(auto_now=True)
 
 
 
     @classmethod
-    def new_game(cls, user):
-        """Creates and returns a new game"""
-        game = Game(user=user,
-                    target_word=random.choice(words),
+    def new_game(cls, user, difficulty=None, length=None):
+        """Creates and returns a new game. The target word can be restricted
+        to a difficulty ('easy', 'medium' or 'hard') and/or a length; raises
+        ValueError if the dictionary has no such word. The game is written
+        together with its entry in the user's active_games, and belongs to
+        the user's current key if user was migrated."""
+        game_id, _ = cls.allocate_ids(1)
+        game = Game(id=game_id,
+                    user=user,
+                    target_word=get_dictionary().random_word(difficulty,
+                                                             length),
                     attempts=0,
-                    game_over=False,
-                    guessed_letters = "",
-                    history = [])
+                    game_over=False)
         game.word_so_far = ("*" * len(game.target_word))
-        game.put()
+
+        @ndb.transactional(xg=True)
+        def put_game():
+            user_entity = User.get_current(user)
+            game.user = user_entity.key
+            user_entity.active_games.append(game.key)
+            ndb.put_multi([game, user_entity])
+        put_game()
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def _pre_put_hook(self):
+        self.version += 1
+
+    def _post_put_hook(self, future):
+        if not future.get_exception():
+            Game.cache.set(self)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        if not future.get_exception():
+            cls.cache.delete(key)
+
+    def letter_masks(self):
+        """Returns the guessed and wrong letter masks of the game"""
+        if self.guessed_letters and not self.guessed_mask:
+            word = engine.get_word(self.target_word)
+            self.guessed_mask = engine.letters_mask(self.guessed_letters)
+            self.wrong_mask = self.guessed_mask & ~word.mask
+            self.guessed_letters = None
+        return self.guessed_mask, self.wrong_mask
+
+    def log_move(self, guess, outcome):
+        """Appends a move and its engine outcome to the move log"""
+        self.moves = movelog.append(self.moves, guess, outcome)
+
+    def get_history(self, offset=0, limit=None):
+        """Returns the readable history of moves offset to offset + limit,
+        and the total number of moves"""
+        legacy = self.history
+        end = None if limit is None else offset + limit
+        history = legacy[offset:end]
+        if limit is not None:
+            limit -= len(history)
+        wrong_mask = 0
+        if legacy:
+            wrong_mask = (self.letter_masks()[1] &
+                          ~movelog.wrong_letters(self.moves))
+        history += movelog.render(self.moves, self.target_word,
+                                  max(offset - len(legacy), 0), limit,
+                                  wrong_mask)
+        return history, len(legacy) + movelog.count(self.moves)
+
+    @classmethod
+    def to_forms(cls, games, message, user_names=None):
+        """Returns a GameForms for games, resolving every user name in a
+        single batch"""
+        games = list(games)
+        user_names = get_user_names([game.user for game in games], user_names)
+        return GameForms(items=[game.to_form(message, user_names[game.user])
+                                for game in games])
+
+    def to_form(self, message, user_name=None):
+        """Returns a GameForm representation of the Game. user_name is looked
+        up from the datastore unless it's given."""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
         form.game_over = self.game_over
         form.message = message
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user.get().name
         form.word_so_far = self.word_so_far
         form.attempts = self.attempts
+        form.version = self.version
         return form
 
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. Nothing is written here: returns the new Score, the
+        updated User, a GameStatsShard and, if the score qualifies, the
+        updated LowScoreBoard, which the caller must put together with the
+        game inside its transaction."""
         self.game_over = True
-        self.put()
+        user = User.get_current(self.user)
         # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
-                      guesses=self.attempts)
-        score.put()
+        score = Score(user=user.key, date=date.today(), won=won,
+                      guesses=self.attempts, finished=datetime.now())
+        user.record_score(won, self.attempts)
+        if self.key in user.active_games:
+            user.active_games.remove(self.key)
+        entities = [score, user,
+                    GameStatsShard.record_game(won, self.attempts)]
+        if won:
+            board = LowScoreBoard.add_score(score)
+            if board:
+                entities.append(board)
+        return entities
 
 
 class Score(ndb.Model):
@@ -97,11 +265,215 @@ class Score(ndb.Model):
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
+    # When the game ended; Scores from before it was recorded have none
+    finished = ndb.DateTimeProperty(indexed=False)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    @classmethod
+    def to_forms(cls, scores, user_names=None, won=None, next_cursor=None):
+        """Returns a ScoreForms for scores, resolving every user name in a
+        single batch. won is passed on to to_form for every score."""
+        scores = list(scores)
+        user_names = get_user_names([score.user for score in scores],
+                                    user_names)
+        return ScoreForms(items=[score.to_form(user_names[score.user], won)
+                                 for score in scores],
+                          next_cursor=next_cursor)
+
+    def to_form(self, user_name=None, won=None):
+        """Returns a ScoreForm representation of the Score. user_name is
+        looked up from the datastore unless it's given. Projection queries
+        can't return the properties they filter on by equality, so those
+        can be passed in as user_name and won instead."""
+        return ScoreForm(user_name=user_name or self.user.get().name,
+                         won=self.won if won is None else won,
                          date=str(self.date), guesses=self.guesses)
 
+class ScoreSummary(ndb.Model):
+    """The Scores of one user's games finished in one month, rolled up by the
+    score compaction in scores.py once they're old enough. The Scores
+    themselves are deleted."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    month = ndb.DateProperty(required=True)
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    guesses = ndb.IntegerProperty(default=0, indexed=False)
+    # Fewest guesses of a won game, None if none were won
+    best = ndb.IntegerProperty()
+    # Guesses of the month's best wins, fewest first, as many as fit on the
+    # LowScoreBoard, so a rebuilt board still lists them
+    best_wins = ndb.IntegerProperty(repeated=True, indexed=False)
+    # The Scores added by the last compaction batch, so a retried batch
+    # doesn't add them twice
+    recent_scores = ndb.KeyProperty(kind='Score', repeated=True,
+                                    indexed=False)
+
+    @classmethod
+    def summary_key(cls, user_key, day):
+        """The key of the summary of user_key's games in the month of day.
+        It's built from the whole user key, so a legacy numeric id can't
+        collide with a user named after it."""
+        return ndb.Key(cls, '{}:{:%Y-%m}'.format(user_key.urlsafe(), day))
+
+    def add_scores(self, scores):
+        """Adds scores, all of this summary's user and month, skipping those
+        the previous batch already added. Returns whether anything was
+        added."""
+        recent = set(self.recent_scores)
+        best_wins = self.get_best_wins()
+        added = False
+        for score in scores:
+            if score.key in recent:
+                continue
+            added = True
+            self.games += 1
+            self.guesses += score.guesses
+            if score.won:
+                self.wins += 1
+                bisect.insort(best_wins, score.guesses)
+        self._set_best_wins(best_wins)
+        self.recent_scores = [score.key for score in scores]
+        return added
+
+    def merge(self, other):
+        """Adds the totals of another summary of the same month"""
+        self.games += other.games
+        self.wins += other.wins
+        self.guesses += other.guesses
+        self._set_best_wins(sorted(self.get_best_wins() +
+                                   other.get_best_wins()))
+        self.recent_scores += other.recent_scores
+
+    def get_best_wins(self):
+        """The guesses of the best wins, fewest first. Summaries compacted
+        before best_wins was kept only know their best one."""
+        if self.best_wins:
+            return list(self.best_wins)
+        return [self.best] if self.best is not None else []
+
+    def _set_best_wins(self, best_wins):
+        self.best_wins = best_wins[:LOW_SCORE_BOARD_SIZE]
+        self.best = best_wins[0] if best_wins else None
+
+    def to_form(self, user_name):
+        """Returns a ScoreForm representation of the summary: date is the
+        month, guesses the total over all its games and won whether any of
+        them was won"""
+        return ScoreForm(user_name=user_name, date=self.month.strftime('%Y-%m'),
+                         won=self.wins > 0, guesses=self.guesses,
+                         games=self.games, wins=self.wins,
+                         best_guesses=self.best)
+
+
+class LowScoreEntry(ndb.Model):
+    """A won game on the LowScoreBoard"""
+    user = ndb.KeyProperty(required=True, kind='User')
+    date = ndb.DateProperty(required=True)
+    guesses = ndb.IntegerProperty(required=True)
+
+
+class LowScoreBoard(ndb.Model):
+    """The LOW_SCORE_BOARD_SIZE won games with the fewest guesses, in
+    ascending order, kept in a single entity. Game.end_game inserts the games
+    that qualify, so get_low_scores can read the best scores without sorting
+    Score. A copy of the entries is cached in memcache. The board is built,
+    and periodically rebuilt, by the /tasks/rebuild_low_scores task."""
+    entries = ndb.LocalStructuredProperty(LowScoreEntry, repeated=True)
+
+    @classmethod
+    def board_key(cls):
+        return ndb.Key(cls, 'board')
+
+    @classmethod
+    def get_entries(cls):
+        """Returns the board's entries as (guesses, date, user key) tuples, or
+        None if the board hasn't been built yet"""
+        entries = memcache.get(LOW_SCORE_BOARD_MEMCACHE_KEY)
+        if entries is None:
+            board = cls.board_key().get()
+            if not board:
+                return None
+            entries = board.entry_tuples()
+            memcache.add(LOW_SCORE_BOARD_MEMCACHE_KEY, entries,
+                         time=LOW_SCORE_BOARD_TTL)
+        return entries
+
+    @classmethod
+    @ndb.non_transactional
+    def _get_entries_outside_transaction(cls):
+        """get_entries, reading the board outside the caller's transaction
+        on a memcache miss and caching it again"""
+        return cls.get_entries()
+
+    @staticmethod
+    def qualifies(entries, guesses):
+        """Whether a win in guesses makes it onto a board holding entries, as
+        returned by get_entries"""
+        return (len(entries) < LOW_SCORE_BOARD_SIZE or
+                guesses < entries[-1][0])
+
+    @classmethod
+    def add_score(cls, score):
+        """Inserts a won Score if it qualifies. Returns the updated board for
+        the caller to put in its transaction, or None. Until the board has
+        been built from the existing Scores (see lowscores.rebuild_board)
+        nothing is inserted."""
+        # Most wins don't qualify; the cached board rules them out without
+        # adding the board to the caller's transaction
+        entries = cls._get_entries_outside_transaction()
+        if entries is None or not cls.qualifies(entries, score.guesses):
+            return None
+        board = cls.board_key().get()
+        if not board or not cls.qualifies(board.entry_tuples(), score.guesses):
+            return None
+        position = len(board.entries)
+        while position and board.entries[position - 1].guesses > score.guesses:
+            position -= 1
+        board.entries.insert(position, LowScoreEntry(
+            user=score.user, date=score.date, guesses=score.guesses))
+        del board.entries[LOW_SCORE_BOARD_SIZE:]
+        return board
+
+    def entry_tuples(self):
+        return [(entry.guesses, entry.date, entry.user)
+                for entry in self.entries]
+
+    def _post_put_hook(self, future):
+        if not future.get_exception():
+            entries = self.entry_tuples()
+            ndb.get_context().call_on_commit(
+                lambda: memcache.set(LOW_SCORE_BOARD_MEMCACHE_KEY, entries,
+                                     time=LOW_SCORE_BOARD_TTL))
+
+
+class GameStatsShard(ndb.Model):
+    """Running totals of a share of all finished games. Game.end_game adds
+    each game to a random one of GAME_STATS_SHARDS shards, and gamestats.py
+    adds the shards up. The games that ended before the shards existed are
+    counted on one more entity, written by gamestats.backfill_batch."""
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls):
+        return [ndb.Key(cls, str(shard)) for shard in range(GAME_STATS_SHARDS)]
+
+    @classmethod
+    def backfill_key(cls):
+        return ndb.Key(cls, 'backfill')
+
+    @classmethod
+    def record_game(cls, won, attempts):
+        """Adds a finished game to a random shard. Returns the shard for the
+        caller to put in its transaction."""
+        key = ndb.Key(cls, str(random.randrange(GAME_STATS_SHARDS)))
+        shard = key.get() or cls(key=key)
+        shard.games += 1
+        shard.wins += 1 if won else 0
+        shard.attempts += attempts
+        return shard
+
+
 class UserForm(messages.Message):
     """UserForm for outbound User information"""
     user_name = messages.StringField(1, required=True)
@@ -113,6 +485,7 @@ class UserForm(messages.Message):
 class UserForms(messages.Message):
     """Return multiple UserForms"""
     items = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
@@ -122,6 +495,7 @@ class GameForm(messages.Message):
     user_name = messages.StringField(4, required=True)
     attempts = messages.IntegerField(5, required=True)
     word_so_far = messages.StringField(6)
+    version = messages.IntegerField(7)
 
 
 class GameForms(messages.Message):
@@ -129,31 +503,84 @@ class GameForms(messages.Message):
     items = messages.MessageField(GameForm, 1, repeated=True)
 
 
+class Difficulty(messages.Enum):
+    """Difficulty of a game's target word"""
+    EASY = 1
+    MEDIUM = 2
+    HARD = 3
+
+
 class NewGameForm(messages.Message):
-    """Used to create a new game"""
+    """Used to create a new game. difficulty and word_length optionally
+    restrict the choice of target word."""
     user_name = messages.StringField(1, required=True)
+    difficulty = messages.EnumField(Difficulty, 2)
+    word_length = messages.IntegerField(3)
 
 
 class MakeMoveForm(messages.Message):
-    """Used to make a move in an existing game"""
+    """Used to make a move in an existing game. version is optional: if it's
+    given and the game has moved on since, the move is rejected."""
+    guess = messages.StringField(1, required=True)
+    version = messages.IntegerField(2)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make a sequence of moves in an existing game. version is
+    optional, as in MakeMoveForm."""
+    guesses = messages.StringField(1, repeated=True)
+    version = messages.IntegerField(2)
+
+
+class MoveResultForm(messages.Message):
+    """The outcome of a single move"""
     guess = messages.StringField(1, required=True)
+    message = messages.StringField(2, required=True)
+
+
+class MovesForm(messages.Message):
+    """Return the result of each move and the final game state"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
 
 
 class ScoreForm(messages.Message):
-    """ScoreForm for outbound Score information"""
+    """ScoreForm for outbound Score information. Games older than the score
+    compaction age are returned as one form per user and month, with games,
+    wins and best_guesses set."""
     user_name = messages.StringField(1, required=True)
     date = messages.StringField(2, required=True)
     won = messages.BooleanField(3, required=True)
     guesses = messages.IntegerField(4, required=True)
+    games = messages.IntegerField(5)
+    wins = messages.IntegerField(6)
+    best_guesses = messages.IntegerField(7)
 
 
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+class GameStatsForm(messages.Message):
+    """GameStatsForm for outbound statistics of all finished games"""
+    games_finished = messages.IntegerField(1, required=True)
+    games_won = messages.IntegerField(2, required=True)
+    average_attempts = messages.FloatField(3, required=True)
+    win_rate = messages.FloatField(4, required=True)
+
+
+class HintForm(messages.Message):
+    """HintForm for outbound hints about a game in progress"""
+    word_so_far = messages.StringField(1, required=True)
+    candidates = messages.IntegerField(2, required=True)
+    letter = messages.StringField(3)
+
 
 class HistoryForm(messages.Message):
     """HistoryForm for outbound History information"""
     items = messages.StringField(1, repeated = True)
+    total = messages.IntegerField(2)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,64 @@
+"""movelog.py - Compact, append-only encoding of a game's moves.
+
+Each move is a fixed 6 byte header (timestamp in seconds, engine outcome code,
+guess length) followed by the guess itself, truncated to MAX_GUESS_BYTES so a
+long or abusive game can't blow up the entity. The messages shown to players
+are not stored; render() rebuilds them from the outcome codes on demand."""
+
+import struct
+import time
+
+import engine
+
+_HEADER = struct.Struct('<IBB')
+MAX_GUESS_BYTES = 32
+
+
+def append(log, guess, outcome, timestamp=None):
+    """Returns log with one move added"""
+    if timestamp is None:
+        timestamp = time.time()
+    if isinstance(guess, unicode):
+        guess = guess.encode('utf-8')
+    guess = guess[:MAX_GUESS_BYTES]
+    return ((log or '') + _HEADER.pack(int(timestamp), outcome, len(guess)) +
+            guess)
+
+
+def iter_moves(log):
+    """Yields (timestamp, outcome, guess) for every move in log"""
+    position = 0
+    log = log or ''
+    while position < len(log):
+        timestamp, outcome, length = _HEADER.unpack_from(log, position)
+        position += _HEADER.size
+        guess = log[position:position + length].decode('utf-8', 'replace')
+        position += length
+        yield timestamp, outcome, guess
+
+
+def count(log):
+    """Returns the number of moves in log"""
+    return sum(1 for _ in iter_moves(log))
+
+
+def wrong_letters(log):
+    """Returns the mask of the incorrect letters guessed in log"""
+    return engine.letters_mask(guess for _, outcome, guess in iter_moves(log)
+                               if outcome in (engine.INCORRECT, engine.LOSE))
+
+
+def render(log, target_word, offset=0, limit=None, wrong_mask=0):
+    """Returns the human readable history of moves offset to offset + limit.
+    wrong_mask holds any incorrect letters guessed before the log began."""
+    history = []
+    for i, (timestamp, outcome, guess) in enumerate(iter_moves(log)):
+        if limit is not None and i >= offset + limit:
+            break
+        # The miss count in a message is the one after that move was made
+        if outcome in (engine.INCORRECT, engine.LOSE):
+            wrong_mask |= engine.letters_mask(guess)
+        if i >= offset:
+            msg = engine.message(outcome, guess, target_word, wrong_mask)
+            history.append("(Guess: " + guess + ", Message: " + msg + ")")
+    return history
@@ -0,0 +1,141 @@
+"""rankings.py - Serves the player leaderboard from the per-user totals kept
+on User, and rebuilds those totals from existing Scores."""
+
+import logging
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import User, Game, Score, ScoreSummary, UserForm, UserForms
+from utils import get_cursor, get_page_size, urlsafe_cursor, DEFAULT_PAGE_SIZE
+
+# The first page is by far the most requested one, so a copy of it is kept in
+# memcache. Rankings may lag a finished game by up to SNAPSHOT_TTL seconds.
+SNAPSHOT_KEY = 'rankings:snapshot'
+SNAPSHOT_TTL = 60
+BACKFILL_URL = '/tasks/backfill_user_totals'
+BACKFILL_BATCH_SIZE = 50
+# Seconds before Users that finished a game during the backfill are retried
+BACKFILL_RETRY_DELAY = 60
+# Leaves room for the User in a cross group transaction
+GAMES_PER_TRANSACTION = 24
+
+
+def ranking_query():
+    """Users with at least one Score, ordered by winning_percentage, then
+    number of wins, then fewest guesses"""
+    return User.query(User.ranked == True).order(
+        -User.winning_percentage, -User.wins, User.guesses)
+
+
+def get_rankings_page(page_size=None, cursor=None):
+    """Returns a page of the rankings as a UserForms"""
+    page_size = get_page_size(page_size)
+    use_snapshot = not cursor and page_size == DEFAULT_PAGE_SIZE
+    page = memcache.get(SNAPSHOT_KEY) if use_snapshot else None
+    if page is None:
+        users, next_cursor, more = ranking_query().fetch_page(
+            page_size, start_cursor=get_cursor(cursor))
+        # Plain tuples keep the memcache value small and picklable
+        page = ([(u.name, u.email, u.wins, u.guesses, u.winning_percentage)
+                 for u in users],
+                urlsafe_cursor(next_cursor, more))
+        if use_snapshot:
+            memcache.set(SNAPSHOT_KEY, page, time=SNAPSHOT_TTL)
+    rows, next_cursor = page
+    return UserForms(
+        items=[UserForm(user_name=name, email=email, wins=wins,
+                        guesses=guesses, winning_percentage=percentage)
+               for name, email, wins, guesses, percentage in rows],
+        next_cursor=next_cursor)
+
+
+@ndb.transactional
+def _set_totals(user_key, games_played, scores, summaries):
+    """Replaces a User's running totals by those of scores and summaries,
+    unless a game ended since the User was read with games_played (its Score
+    may be missing from scores). Returns False if so. The totals are also
+    kept if scores and summaries count fewer games than the User already
+    has, as the queries may not see the newest Scores yet."""
+    user = user_key.get()
+    if not user:
+        return True
+    if user.games_played != games_played:
+        return False
+    # A Score compacted meanwhile can still show up next to its summary
+    summarized = set(key for summary in summaries
+                     for key in summary.recent_scores)
+    scores = [score for score in scores if score.key not in summarized]
+    counted = len(scores) + sum(summary.games for summary in summaries)
+    if counted < user.games_played:
+        logging.warning('Kept the totals of %s: %d games counted, %d played',
+                        user.name, counted, user.games_played)
+        return True
+    user.games_played = user.wins = user.guesses = 0
+    user.winning_percentage = 0.0
+    for score in scores:
+        user.record_score(score.won, score.guesses)
+    for summary in summaries:
+        user.record_summary(summary)
+    user.put()
+    return True
+
+
+def _enqueue_retry(user_keys):
+    """Adds a task that backfills user_keys again once their games have
+    settled"""
+    from google.appengine.api import taskqueue
+    taskqueue.add(url=BACKFILL_URL, countdown=BACKFILL_RETRY_DELAY,
+                  params={'user': [key.urlsafe() for key in user_keys]})
+
+
+@ndb.transactional(xg=True)
+def _add_active_games(user_key, game_keys):
+    """Adds those of game_keys that are still the User's unfinished games to
+    its active_games"""
+    user = user_key.get()
+    if not user:
+        return
+    added = [game.key for game in ndb.get_multi(game_keys)
+             if game and not game.game_over and game.user == user_key and
+             game.key not in user.active_games]
+    if added:
+        user.active_games.extend(added)
+        user.put()
+
+
+def backfill_user_totals(cursor=None, users=()):
+    """Recomputes the running totals of one batch of Users, or of the Users
+    of the urlsafe keys users, from their Scores and ScoreSummaries, and adds
+    any unfinished Games missing from their active_games. Users that finish
+    a game meanwhile are retried by a later task. Returns the urlsafe cursor
+    of the next batch, or None when done."""
+    if users:
+        users = [user for user in ndb.get_multi(
+            [ndb.Key(urlsafe=key) for key in users]) if user]
+        next_cursor = more = None
+    else:
+        users, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=get_cursor(cursor))
+    # The Users are read before their Scores are queried, so a game that
+    # ends in between shows in games_played
+    futures = [(Score.query(Score.user == user.key).fetch_async(),
+                ScoreSummary.query(ScoreSummary.user == user.key)
+                    .fetch_async(),
+                Game.query(Game.user == user.key, Game.game_over == False)
+                    .fetch_async(keys_only=True))
+               for user in users]
+    retry = []
+    for user, (scores, summaries, games) in zip(users, futures):
+        if not _set_totals(user.key, user.games_played, scores.get_result(),
+                           summaries.get_result()):
+            retry.append(user.key)
+        missing = [key for key in games.get_result()
+                   if key not in user.active_games]
+        for i in range(0, len(missing), GAMES_PER_TRANSACTION):
+            _add_active_games(user.key, missing[i:i + GAMES_PER_TRANSACTION])
+    if retry:
+        _enqueue_retry(retry)
+    logging.info('Backfilled totals for %d users, %d to retry', len(users),
+                 len(retry))
+    memcache.delete(SNAPSHOT_KEY)
+    return urlsafe_cursor(next_cursor, more)
@@ -0,0 +1,106 @@
+"""reminders.py - Daily reminder emails to users with unfinished games.
+
+The cron only enqueues the first batch. Each batch task reads one page of
+keys of users with active games (User.has_active_games), enqueues the task
+for the next page, then mails the users of its own page. Tasks are named
+after the day and page number, and each user's last_reminded day is set in
+a transaction before they're mailed, so a repeated cron run or a retried
+task never mails anyone twice in a day. Progress is counted in memcache."""
+
+import logging
+from datetime import date, datetime
+from google.appengine.api import app_identity, memcache
+from google.appengine.ext import ndb
+
+from models import User
+from utils import get_cursor, urlsafe_cursor
+
+QUEUE_NAME = 'reminders'
+TASK_URL = '/tasks/send_reminders'
+BATCH_SIZE = 100
+COUNTERS = ('batches', 'users', 'sent')
+
+
+def _counters_prefix(day):
+    return 'reminders:{}:'.format(day)
+
+
+def _enqueue(day, page, cursor=None):
+    """Adds the task for one page, unless it was already added today"""
+    from google.appengine.api import taskqueue
+    params = {'day': day, 'page': page}
+    if cursor:
+        params['cursor'] = cursor
+    try:
+        taskqueue.add(url=TASK_URL, params=params, queue_name=QUEUE_NAME,
+                      name='reminders-{}-{}'.format(day, page))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Reminder page %d for %s was already enqueued', page, day)
+
+
+def start(day=None):
+    """Starts the day's reminder run"""
+    _enqueue(day or date.today().strftime('%Y%m%d'), 0)
+
+
+@ndb.transactional
+def _mark_reminded(user_key, day):
+    """Sets the User's last_reminded to day. Returns the day it replaces, or
+    False if the User was already reminded on day."""
+    user = user_key.get()
+    if not user or user.last_reminded == day:
+        return False
+    previous = user.last_reminded
+    user.last_reminded = day
+    user.put()
+    return previous
+
+
+@ndb.transactional
+def _unmark_reminded(user_key, day, previous):
+    """Puts back the last_reminded that _mark_reminded replaced"""
+    user = user_key.get()
+    if user and user.last_reminded == day:
+        user.last_reminded = previous
+        user.put()
+
+
+def send_batch(day, page, cursor=None):
+    """Mails the users of one page and enqueues the next page"""
+    from google.appengine.api import mail
+    query = User.query(User.has_active_games == True)
+    keys, next_cursor, more = query.fetch_page(BATCH_SIZE, keys_only=True,
+                                               start_cursor=get_cursor(cursor))
+    if more:
+        _enqueue(day, page + 1, urlsafe_cursor(next_cursor, more))
+
+    today = datetime.strptime(day, '%Y%m%d').date()
+    users = [user for user in ndb.get_multi(keys)
+             if user and user.email and user.last_reminded != today]
+    sender = 'noreply@{}.appspotmail.com'.format(
+        app_identity.get_application_id())
+    sent = 0
+    for user in users:
+        previous = _mark_reminded(user.key, today)
+        if previous is False:
+            continue
+        subject = 'This is a reminder to prevent an execution!'
+        body = 'Hello {}, please complete your Hangman game!'.format(user.name)
+        try:
+            mail.send_mail(sender, user.email, subject, body)
+        except Exception:
+            # Let the retried task mail this user
+            _unmark_reminded(user.key, today, previous)
+            raise
+        sent += 1
+
+    memcache.offset_multi({'batches': 1, 'users': len(keys), 'sent': sent},
+                          key_prefix=_counters_prefix(day), initial_value=0)
+    logging.info('Reminders %s page %d: %d users, %d mails sent', day, page,
+                 len(keys), sent)
+
+
+def progress(day):
+    """Returns the counters of a day's run as a dict"""
+    counts = memcache.get_multi(COUNTERS, key_prefix=_counters_prefix(day))
+    return dict((counter, counts.get(counter, 0)) for counter in COUNTERS)
@@ -0,0 +1,154 @@
+"""scores.py - Score paging and compaction.
+
+Scores older than a configurable age are rolled up into one ScoreSummary per
+user and month, and deleted, so Score and its indexes stop growing with the
+whole history of the game. The compaction runs in chained task queue
+batches; each batch reads a page of old Scores, adds them to their
+summaries with one put_multi and deletes them with one delete_multi.
+
+The score endpoints page through the remaining Scores first, newest first,
+then through the summaries, newest month first, as one list."""
+
+import collections
+import logging
+from datetime import date, datetime, timedelta
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Score, ScoreForms, ScoreSummary, get_user_names
+from utils import get_cursor, get_page_size, urlsafe_cursor
+
+TASK_URL = '/tasks/compact_scores'
+# Scores of games finished this many days ago or earlier are compacted
+DEFAULT_MAX_AGE_DAYS = 90
+COMPACTION_BATCH_SIZE = 200
+COUNTERS = ('batches', 'scores', 'summaries')
+# Page tokens of pages past the last Score
+SUMMARY_CURSOR_PREFIX = 'summaries:'
+
+
+def _counters_prefix(run):
+    return 'compact_scores:{}:'.format(run)
+
+
+def _enqueue(run, page, cutoff, cursor=None):
+    """Adds the task for one batch, unless it was already added in this
+    run"""
+    from google.appengine.api import taskqueue
+    params = {'run': run, 'page': page, 'cutoff': cutoff.isoformat()}
+    if cursor:
+        params['cursor'] = cursor
+    try:
+        taskqueue.add(url=TASK_URL, params=params,
+                      name='compact-scores-{}-{}'.format(run, page))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Compaction batch %d of run %s was already enqueued',
+                     page, run)
+
+
+def compaction_cutoff(max_age_days=DEFAULT_MAX_AGE_DAYS, today=None):
+    """The first day of the month holding the day max_age_days ago. Only
+    whole months before it are compacted, so every summary covers a
+    complete month."""
+    day = (today or date.today()) - timedelta(days=max_age_days)
+    return day.replace(day=1)
+
+
+def start(max_age_days=DEFAULT_MAX_AGE_DAYS, run=None):
+    """Starts a compaction run of the Scores older than max_age_days.
+    Returns the run's name."""
+    run = run or date.today().strftime('%Y%m%d')
+    _enqueue(run, 0, compaction_cutoff(max_age_days))
+    return run
+
+
+def compact_batch(run, page, cutoff, cursor=None):
+    """Rolls one batch of the Scores dated before cutoff into their
+    ScoreSummaries, deletes them and enqueues the next batch"""
+    scores, next_cursor, more = Score.query(Score.date < cutoff).fetch_page(
+        COMPACTION_BATCH_SIZE, start_cursor=get_cursor(cursor))
+
+    groups = collections.defaultdict(list)
+    for score in scores:
+        groups[ScoreSummary.summary_key(score.user, score.date)].append(score)
+    keys = list(groups)
+    updated = []
+    for key, summary in zip(keys, ndb.get_multi(keys)):
+        first = groups[key][0]
+        summary = summary or ScoreSummary(
+            key=key, user=first.user, month=first.date.replace(day=1))
+        # A retried batch finds its summaries already updated
+        if summary.add_scores(groups[key]):
+            updated.append(summary)
+    # The summaries are written first: an interrupted batch is retried, and
+    # only deletes the Scores it had already added
+    ndb.put_multi(updated)
+    ndb.delete_multi([score.key for score in scores])
+    if more:
+        _enqueue(run, page + 1, cutoff, urlsafe_cursor(next_cursor, more))
+
+    memcache.offset_multi({'batches': 1, 'scores': len(scores),
+                           'summaries': len(updated)},
+                          key_prefix=_counters_prefix(run), initial_value=0)
+    logging.info('Score compaction %s batch %d: %d scores into %d summaries',
+                 run, page, len(scores), len(updated))
+
+
+def parse_cutoff(value):
+    """Parses a cutoff passed to a batch task"""
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def progress(run):
+    """Returns the counters of a compaction run as a dict"""
+    counts = memcache.get_multi(COUNTERS, key_prefix=_counters_prefix(run))
+    return dict((counter, counts.get(counter, 0)) for counter in COUNTERS)
+
+
+def get_scores_page(page_size=None, cursor=None, user_key=None,
+                    user_name=None):
+    """Returns a page of scores, newest first, as a ScoreForms: all scores,
+    or only those of user_key (named user_name) if it's given. The Scores
+    still stored come first, then the ScoreSummaries of older months."""
+    page_size = get_page_size(page_size)
+    items = []
+    user_names = {user_key: user_name} if user_key else {}
+
+    if not (cursor or '').startswith(SUMMARY_CURSOR_PREFIX):
+        if user_key:
+            query = Score.query(Score.user == user_key)
+            projection = [Score.date, Score.won, Score.guesses]
+        else:
+            query = Score.query()
+            projection = [Score.user, Score.date, Score.won, Score.guesses]
+        scores, next_cursor, more = query.order(-Score.date).fetch_page(
+            page_size, start_cursor=get_cursor(cursor), projection=projection)
+        if user_key:
+            items = [score.to_form(user_name) for score in scores]
+        else:
+            items = Score.to_forms(scores, user_names).items
+        if more:
+            return ScoreForms(items=items,
+                              next_cursor=urlsafe_cursor(next_cursor, more))
+        # Past the last Score: the rest of the page comes from the summaries
+        page_size -= len(scores)
+        cursor = None
+    else:
+        cursor = cursor[len(SUMMARY_CURSOR_PREFIX):] or None
+
+    query = ScoreSummary.query()
+    if user_key:
+        query = query.filter(ScoreSummary.user == user_key)
+    query = query.order(-ScoreSummary.month)
+    if not page_size:
+        more = query.get(keys_only=True) is not None
+        return ScoreForms(items=items,
+                          next_cursor=SUMMARY_CURSOR_PREFIX if more else None)
+    summaries, next_cursor, more = query.fetch_page(
+        page_size, start_cursor=get_cursor(cursor))
+    get_user_names([summary.user for summary in summaries], user_names)
+    items.extend(summary.to_form(user_names[summary.user])
+                 for summary in summaries)
+    next_cursor = urlsafe_cursor(next_cursor, more)
+    return ScoreForms(items=items, next_cursor=(
+        SUMMARY_CURSOR_PREFIX + next_cursor if next_cursor else None))
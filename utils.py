@@ -1,14 +1,31 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-import endpoints
+
+from models import User
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def bad_request(message):
+    """Returns an endpoints.BadRequestException. endpoints is only imported
+    here, so the task and cron handlers that share these helpers don't load
+    it."""
+    import endpoints
+    return endpoints.BadRequestException(message)
+
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
         error if the key String is malformed or the entity is of the incorrect
-        kind
+        kind. Models with a cache attribute (a cache.VersionedCache) are read
+        through it, except inside transactions, which always read the
+        datastore
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
@@ -20,17 +37,106 @@ def get_by_urlsafe(urlsafe, model):
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
+        raise bad_request('Invalid Key')
     except Exception, e:
         if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
+            raise bad_request('Invalid Key')
         else:
             raise
 
-    entity = key.get()
+    cache = getattr(model, 'cache', None)
+    if (cache and key.kind() == model._get_kind() and
+            not ndb.in_transaction()):
+        entity = cache.get(key)
+    else:
+        entity = key.get()
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
 
+
+def _user_cache_key(name):
+    return 'user:' + name
+
+
+def get_user_key(name):
+    """Returns the key of the User with the given name, or None if there's no
+        such user. Names are cached in memcache once resolved, so this costs
+        no datastore RPC on a cache hit and at most one get otherwise.
+    Args:
+        name: A user name
+    Returns:
+        The User's ndb.Key or None"""
+    urlsafe = memcache.get(_user_cache_key(name))
+    if urlsafe:
+        return ndb.Key(urlsafe=urlsafe)
+    user = User.get_by_id(name)
+    if not user:
+        # Users created before names became keys can only be found by name
+        user = User.query(User.name == name).get()
+        if user and user.moved_to:
+            user = user.moved_to.get()
+    if not user:
+        return None
+    cache_user(user)
+    return user.key
+
+
+def get_user(name):
+    """Returns the User with the given name, or None if there's no such user.
+        Costs one get on a cache hit.
+    Args:
+        name: A user name"""
+    key = get_user_key(name)
+    return User.get_current(key) if key else None
+
+
+def cache_user(user):
+    """Writes the name -> key mapping of a new or migrated User through to
+        memcache.
+    Args:
+        user: A User"""
+    memcache.set(_user_cache_key(user.name), user.key.urlsafe())
+
+
+def uncache_user(name):
+    """Forgets the cached key of a user name, e.g. when the User is re-keyed
+    Args:
+        name: A user name"""
+    memcache.delete(_user_cache_key(name))
+
+
+def get_page_size(page_size):
+    """Returns the number of results to fetch for a requested page size,
+    falling back to DEFAULT_PAGE_SIZE and capped at MAX_PAGE_SIZE"""
+    if not page_size or page_size < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(page_size, MAX_PAGE_SIZE)
+
+
+def get_cursor(urlsafe):
+    """Returns the datastore Cursor for an opaque page token handed out in a
+        previous response, or None for the first page.
+    Args:
+        urlsafe: A urlsafe cursor string or None
+    Returns:
+        A Cursor, or None if no token was given.
+    Raises:
+        endpoints.BadRequestException: if the token is malformed"""
+    if not urlsafe:
+        return None
+    try:
+        return Cursor(urlsafe=urlsafe)
+    except Exception:
+        raise bad_request('Invalid cursor')
+
+
+def urlsafe_cursor(cursor, more):
+    """Returns the opaque page token for the next page, or None if there are
+        no more results.
+    Args:
+        cursor: The Cursor returned by fetch_page
+        more: Whether fetch_page reported more results"""
+    return cursor.urlsafe() if more and cursor else None
@@ -0,0 +1,62 @@
+"""warmup.py - Prepares a new instance before it's sent any traffic.
+
+App Engine sends /_ah/warmup to every instance it starts ahead of demand.
+Everything a first request would otherwise pay for is done here: importing
+the API (which builds the endpoints server), loading and indexing the word
+dictionary, building its pattern index for hints, and reading the hot shared
+caches so they're filled if they had expired."""
+
+import collections
+import itertools
+import logging
+import time
+
+import engine
+from dictionary import get_dictionary
+from hints import get_pattern_index
+
+
+def _preload_words():
+    engine.preload(itertools.islice(get_dictionary(),
+                                    engine.MAX_INDEXED_WORDS))
+
+
+def _import_api():
+    import api
+    return api
+
+
+def _prime_caches():
+    from models import LowScoreBoard
+    from gamestats import get_game_stats
+    from rankings import get_rankings_page
+    from utils import get_user_key
+    # The top players are the most looked up by name
+    for form in get_rankings_page().items:
+        get_user_key(form.user_name)
+    LowScoreBoard.get_entries()
+    get_game_stats()
+
+
+STEPS = (
+    ('dictionary', get_dictionary),
+    ('words', _preload_words),
+    ('patterns', get_pattern_index),
+    ('api', _import_api),
+    ('caches', _prime_caches),
+)
+
+
+def warm_up():
+    """Runs every warmup step. Returns how long each took, in ms."""
+    timings = collections.OrderedDict()
+    for name, step in STEPS:
+        start = time.time()
+        try:
+            step()
+        except Exception:
+            # A failed step only leaves its work to the first request
+            logging.exception('Warmup step %s failed', name)
+        timings[name] = round((time.time() - start) * 1000, 1)
+    logging.info('Warmed up in %s ms', dict(timings))
+    return timings